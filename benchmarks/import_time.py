@@ -0,0 +1,58 @@
+"""
+Measures how long it takes to import mara-prophet and to run its mara-app discovery hooks, and fails when
+that loads the forecasting and plotting stack (fbprophet, pystan, matplotlib, pandas, numpy)
+
+Usage:
+
+    python benchmarks/import_time.py [--max-seconds 1.0]
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+HEAVY_MODULES = ['fbprophet', 'pystan', 'matplotlib', 'pandas', 'numpy']
+
+# Runs in a fresh interpreter so that nothing has been imported before
+IMPORT_CODE = f'''
+import json
+import sys
+import time
+
+start = time.perf_counter()
+import mara_prophet
+for hook in [mara_prophet.MARA_CONFIG_MODULES, mara_prophet.MARA_AUTOMIGRATE_SQLALCHEMY_MODELS,
+             mara_prophet.MARA_FLASK_BLUEPRINTS, mara_prophet.MARA_ACL_RESOURCES,
+             mara_prophet.MARA_NAVIGATION_ENTRIES, mara_prophet.MARA_CLICK_COMMANDS]:
+    hook()
+seconds = time.perf_counter() - start
+
+print(json.dumps({{'seconds': seconds,
+                  'heavy_modules': [module for module in {HEAVY_MODULES!r} if module in sys.modules]}}))
+'''
+
+
+def measure_import() -> dict:
+    """Imports mara-prophet in a subprocess, returns the import duration and the heavy modules that were loaded"""
+    output = subprocess.run([sys.executable, '-c', IMPORT_CODE], check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--max-seconds', type=float, default=None,
+                        help='fail when importing takes longer than this')
+    parser.add_argument('--repeat', type=int, default=5, help='the number of measurements')
+    args = parser.parse_args()
+
+    results = [measure_import() for _ in range(args.repeat)]
+    seconds = min(result['seconds'] for result in results)
+    heavy_modules = sorted(set(module for result in results for module in result['heavy_modules']))
+
+    print(f'import mara_prophet + discovery hooks: {seconds * 1000:.0f} ms (best of {args.repeat})')
+
+    if heavy_modules:
+        sys.exit(f'Importing mara_prophet loaded {", ".join(heavy_modules)}')
+    if args.max_seconds is not None and seconds > args.max_seconds:
+        sys.exit(f'Importing mara_prophet took longer than {args.max_seconds} seconds')
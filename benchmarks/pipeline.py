@@ -0,0 +1,194 @@
+"""
+Times the forecast pipeline of mara-prophet (query, fit, persist, render) on synthetic time series
+against a PostgreSQL database, at a growing number of metrics
+
+Usage:
+
+    python benchmarks/pipeline.py --database mara_prophet_benchmark [--metrics 1 10 100] [--days 1095] [--workers 8]
+
+The synthetic series are generated by the time series queries themselves, so only an (empty) database is needed.
+All forecasts, the forecast table and the internal tables are written into this database.
+The configuration is patched in this process and inherited by the forked forecast workers (i.e. on Linux).
+"""
+
+import argparse
+import json
+import resource
+import statistics
+import sys
+import time
+import typing
+
+if typing.TYPE_CHECKING:
+    import mara_prophet.forecast
+
+BENCHMARK_PREFIX = 'benchmark_'
+
+
+def configure(args):
+    """Points the 'mara' and the etl database of mara-prophet to the benchmark database"""
+    import mara_db.config
+    import mara_db.dbs
+    import mara_prophet.config
+
+    db = mara_db.dbs.PostgreSQLDB(host=args.host, port=args.port, database=args.database, user=args.user,
+                                  password=args.password)
+    mara_db.config.databases = lambda: {'mara': db, 'benchmark': db}
+    mara_prophet.config.db_alias = lambda: 'benchmark'
+    mara_prophet.config.forecast_table_name = lambda: f'{BENCHMARK_PREFIX}forecasts'
+
+
+def synthetic_forecasts(number_of_metrics: int, args) -> ['mara_prophet.forecast.Forecast']:
+    """Forecasts of positive daily series with a trend, weekly and yearly seasonality and noise"""
+    from mara_prophet.forecast import Forecast
+
+    return [Forecast(metric_name=f'{BENCHMARK_PREFIX}metric_{number}',
+                     number_of_days=args.horizon_days,
+                     time_series_query=f'''
+SELECT day::DATE AS ds,
+       1000 + {number} + 0.1 * row_number() OVER (ORDER BY day)
+         + {args.weekly_amplitude} * sin(2 * pi() * extract(ISODOW FROM day) / 7)
+         + {args.yearly_amplitude} * sin(2 * pi() * extract(DOY FROM day) / 365.25)
+         + {args.noise} * random() AS y
+FROM generate_series(current_date - {args.days - 1}, current_date, INTERVAL '1 day') day''')
+            for number in range(number_of_metrics)]
+
+
+def peak_memory_mb() -> (float, float):
+    """The peak resident memory of this process and of its largest child process"""
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024  # bytes on macOS, kilobytes on linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+
+
+def summarize(values: [float]) -> dict:
+    return {'mean': statistics.mean(values), 'max': max(values)} if values else {}
+
+
+def benchmark(number_of_metrics: int, args) -> dict:
+    """Forecasts `number_of_metrics` synthetic series and requests their plots"""
+    import flask
+    import mara_prophet.config
+    from mara_prophet import forecast, plot_data, views
+
+    forecasts = synthetic_forecasts(number_of_metrics, args)
+    mara_prophet.config.forecasts = lambda: forecasts
+    forecast.create_forecast_table()
+    forecast.create_mara_tables()
+
+    # reading the source data on its own, without fitting
+    read_data_seconds = []
+    for f in forecasts[:args.read_samples]:
+        start = time.perf_counter()
+        f.read_data()
+        read_data_seconds.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    summary = forecast.run_forecasts(workers=args.workers)
+    forecast_seconds = time.perf_counter() - start
+
+    failed = {name: result['error'] for name, result in summary.items() if not result['succeeded']}
+    succeeded = [result for result in summary.values() if result['succeeded']]
+    stages = sorted(set(stage for result in succeeded for stage in result['timings']))
+    payloads = sorted(set(payload for result in succeeded for payload in result['byte_sizes']))
+
+    # plot requests: rendered/decoded (cold), served from the per-run cache (warm) and revalidated (not modified)
+    app = flask.Flask(__name__)
+    app.register_blueprint(views.blueprint)
+    client = app.test_client()
+    views.get_plot_png.cache_clear()
+    plot_data.get_plot_series.cache_clear()
+
+    latencies = {'cold': [], 'warm': [], 'not_modified': []}
+    for f in forecasts[:args.plot_samples]:
+        name = forecast.normalized_metric_name(f.metric_name)
+        for components in ['False', 'True']:
+            url = f'/forecasts/_get_plot_image/{name}/{components}'
+            etag = None
+            for kind in ['cold', 'warm', 'not_modified']:
+                headers = {'If-None-Match': etag} if kind == 'not_modified' and etag else {}
+                start = time.perf_counter()
+                response = client.get(url, headers=headers)
+                latencies[kind].append(time.perf_counter() - start)
+                etag = response.headers.get('ETag', etag)
+
+    parent_memory, worker_memory = peak_memory_mb()
+    return {
+        'metrics': number_of_metrics,
+        'failed': failed,
+        'seconds': forecast_seconds,
+        'metrics_per_minute': len(succeeded) / forecast_seconds * 60,
+        'read_data_seconds': summarize(read_data_seconds),
+        'stage_seconds': {stage: summarize([result['timings'][stage] for result in succeeded
+                                            if stage in result['timings']]) for stage in stages},
+        'payload_bytes': {payload: summarize([result['byte_sizes'][payload] for result in succeeded
+                                              if payload in result['byte_sizes']]) for payload in payloads},
+        'plot_request_seconds': {kind: summarize(values) for kind, values in latencies.items()},
+        'peak_memory_mb': {'parent': parent_memory, 'largest_worker': worker_memory}}
+
+
+def print_result(result: dict):
+    print(f'\n{result["metrics"]} metrics: {result["seconds"]:.1f} s, '
+          f'{result["metrics_per_minute"]:.1f} metrics per minute, '
+          f'peak memory {result["peak_memory_mb"]["parent"]:.0f} MB (largest worker '
+          f'{result["peak_memory_mb"]["largest_worker"]:.0f} MB)')
+    for name, error in result['failed'].items():
+        print(f'  failed {name}: {error}')
+
+    rows = ([('read_data', result['read_data_seconds'])]
+            + [(f'stage {stage}', seconds) for stage, seconds in result['stage_seconds'].items()]
+            + [(f'plot request ({kind})', seconds) for kind, seconds in result['plot_request_seconds'].items()])
+    for label, seconds in rows:
+        if seconds:
+            print(f'  {label:<32} mean {seconds["mean"] * 1000:9.1f} ms   max {seconds["max"] * 1000:9.1f} ms')
+    for payload, sizes in result['payload_bytes'].items():
+        print(f'  {"size " + payload:<32} mean {sizes["mean"] / 1024:9.1f} kB   max {sizes["max"] / 1024:9.1f} kB')
+
+
+def clean_up():
+    """Removes all benchmark forecasts from the database"""
+    import mara_prophet.config
+    from mara_prophet import connections
+
+    with connections.cursor_context('mara') as cursor:
+        cursor.execute(f'''
+        DELETE FROM latest_forecasts WHERE metric_name LIKE '{BENCHMARK_PREFIX}%';
+        DELETE FROM forecasts WHERE metric_name LIKE '{BENCHMARK_PREFIX}%';
+        DROP TABLE IF EXISTS {mara_prophet.config.forecast_table_name()}''')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5432)
+    parser.add_argument('--database', required=True)
+    parser.add_argument('--user', default=None)
+    parser.add_argument('--password', default=None)
+    parser.add_argument('--metrics', type=int, nargs='+', default=[1, 10, 100],
+                        help='the numbers of metrics to forecast, one benchmark each')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='the number of parallel forecasts, defaults to the number of CPUs')
+    parser.add_argument('--days', type=int, default=3 * 365, help='the length of each synthetic series')
+    parser.add_argument('--horizon-days', type=int, default=90, help='the number of forecasted days')
+    parser.add_argument('--weekly-amplitude', type=float, default=100)
+    parser.add_argument('--yearly-amplitude', type=float, default=300)
+    parser.add_argument('--noise', type=float, default=50)
+    parser.add_argument('--read-samples', type=int, default=10, help='the number of metrics to time `read_data` of')
+    parser.add_argument('--plot-samples', type=int, default=10, help='the number of metrics to request plots of')
+    parser.add_argument('--json', default=None, help='also write the results to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the benchmark forecasts in the database')
+    args = parser.parse_args()
+
+    configure(args)
+    results = []
+    try:
+        for number_of_metrics in args.metrics:
+            results.append(benchmark(number_of_metrics, args))
+            print_result(results[-1])
+    finally:
+        if not args.keep:
+            clean_up()
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2, default=str)
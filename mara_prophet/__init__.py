@@ -7,8 +7,10 @@ def MARA_CONFIG_MODULES():
 
 
 def MARA_AUTOMIGRATE_SQLALCHEMY_MODELS():
-    from . import forecast, validation
-    return [forecast.ForecastBase, validation.ForecastCrossValidationBase]
+    from . import anomalies, forecast, jobs, tuning, validation
+    return [forecast.ForecastBase, forecast.LatestForecastBase, validation.ForecastCrossValidationBase,
+            validation.ForecastCrossValidationMetricBase, tuning.ForecastTuningBase, jobs.ForecastJobBase,
+            anomalies.ForecastAnomalyBase]
 
 
 def MARA_FLASK_BLUEPRINTS():
@@ -24,3 +26,9 @@ def MARA_ACL_RESOURCES():
 def MARA_NAVIGATION_ENTRIES():
     from . import views
     return [views.forecasts_navigation_entry()]
+
+
+def MARA_CLICK_COMMANDS():
+    from . import cli
+    return [cli.compact_forecasts, cli.forecast_worker, cli.enqueue_forecasts, cli.fill_forecast_intervals,
+            cli.detect_anomalies]
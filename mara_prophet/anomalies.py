@@ -0,0 +1,158 @@
+"""Detection of actuals outside the uncertainty intervals of the latest stored forecasts, without refitting"""
+
+import datetime
+import logging
+import typing
+
+from mara_prophet import connections, instrumentation
+from psycopg2.extras import execute_values
+import sqlalchemy
+from sqlalchemy.ext.declarative import declarative_base
+
+if typing.TYPE_CHECKING:
+    import pandas as pd
+    from mara_prophet.forecast import Forecast
+
+Base = declarative_base()
+
+
+class ForecastAnomalyBase(Base):
+    """
+    Stores actuals that arrived after a forecast run and lie outside its uncertainty interval.
+    `deviation` is the distance to the exceeded bound in interval widths, negative below the lower bound
+    """
+    __tablename__ = 'forecast_anomalies'
+
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    metric_name = sqlalchemy.Column(sqlalchemy.TEXT, nullable=False)
+    ds = sqlalchemy.Column(sqlalchemy.DateTime, nullable=False)
+    forecast_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('forecasts.id'), nullable=False)
+    y = sqlalchemy.Column(sqlalchemy.Float)
+    yhat = sqlalchemy.Column(sqlalchemy.Float)
+    yhat_lower = sqlalchemy.Column(sqlalchemy.Float)
+    yhat_upper = sqlalchemy.Column(sqlalchemy.Float)
+    deviation = sqlalchemy.Column(sqlalchemy.Float)
+    detected_ts = sqlalchemy.Column(sqlalchemy.DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (sqlalchemy.UniqueConstraint('metric_name', 'ds', name='forecast_anomalies_uk'),)
+
+
+def read_new_actuals(forecasts: {str: 'Forecast'},
+                     last_actual_ds: {str: 'pd.Timestamp'}) -> 'pd.DataFrame':
+    """
+    Reads the actuals after the last actual date of each metric with a single `UNION ALL` query
+
+    Args:
+        forecasts: The forecasts per normalized metric name
+        last_actual_ds: The last actual date that the latest forecast of each metric has been fitted on
+
+    Returns:
+        A data frame with the columns metric_name, ds and y
+    """
+    import numpy as np
+    from mara_prophet.forecast import read_query_into_dataframe
+
+    query = '\nUNION ALL\n'.join(
+        f"SELECT ds, '{metric_name.replace(chr(39), chr(39) * 2)}' AS metric_name, y "
+        f"FROM ({forecasts[metric_name].time_series_query.strip().rstrip(';')}) t "
+        f"WHERE ds > '{last_actual_ds[metric_name].isoformat()}'"
+        for metric_name in last_actual_ds)
+    return read_query_into_dataframe(query, ['ds', 'metric_name', 'y'], {'metric_name': str, 'y': np.float64})
+
+
+def compare_with_intervals(actuals: 'pd.DataFrame', predictions: 'pd.DataFrame') -> 'pd.DataFrame':
+    """
+    Compares actuals with the predicted intervals of all metrics at once
+
+    Args:
+        actuals: The columns metric_name, ds and y
+        predictions: The columns metric_name, forecast_id, ds, yhat, yhat_lower and yhat_upper
+
+    Returns:
+        The compared points with the additional columns `anomaly` and `deviation`
+    """
+    import numpy as np
+
+    points = actuals.merge(predictions, on=['metric_name', 'ds'], how='inner')
+    y, lower, upper = points['y'].values, points['yhat_lower'].values, points['yhat_upper'].values
+    width = np.where(upper > lower, upper - lower, np.nan)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        points['deviation'] = np.select([y > upper, y < lower], [(y - upper) / width, (y - lower) / width], 0.0)
+    # points without intervals (point forecasts) are never anomalies
+    points['anomaly'] = (y > upper) | (y < lower)
+    return points
+
+
+def detect_anomalies(metric_names: [str] = None) -> {str: int}:
+    """
+    Flags actuals that arrived after the latest run of each forecast and lie outside its uncertainty interval,
+    writing them into `forecast_anomalies`. Points that are within the interval again (e.g. after late corrections
+    of the actuals) are unflagged.
+
+    Args:
+        metric_names: The metrics to check, all configured forecasts when not given
+
+    Returns:
+        The number of anomalies per metric name
+    """
+    import pandas as pd
+    from mara_prophet.forecast import BreakdownForecast, ensure_mara_tables, forecasts_by_name, normalized_metric_name
+    from mara_prophet.plot_data import read_plot_series
+
+    instrumentation.add_stdout_logging_handler(logging.getLogger())
+    ensure_mara_tables()
+
+    forecasts = forecasts_by_name()
+    forecasts = {normalized_metric_name(metric_name): forecasts[metric_name]
+                 for metric_name in (metric_names if metric_names is not None else forecasts.keys())
+                 if metric_name in forecasts and not isinstance(forecasts[metric_name], BreakdownForecast)}
+
+    with connections.cursor_context('mara') as cursor:
+        cursor.execute('''
+        SELECT metric_name, forecast_id
+        FROM latest_forecasts WHERE metric_name = ANY(%s)''', (list(forecasts.keys()),))
+        latest_forecasts = dict(cursor.fetchall())
+
+    # the stored plot series hold the actuals the model has been fitted on and the predicted intervals after them
+    plot_series_by_id = read_plot_series(list(latest_forecasts.values()))
+    predictions, last_actual_ds = [], {}
+    for metric_name, forecast_id in latest_forecasts.items():
+        plot_series = plot_series_by_id[forecast_id]
+        future = plot_series['y'].isnull()
+        if plot_series['y'].notnull().any() and future.any():
+            last_actual_ds[metric_name] = plot_series.loc[~future, 'ds'].max()
+            predictions.append(plot_series.loc[future, ['ds', 'yhat', 'yhat_lower', 'yhat_upper']]
+                               .assign(metric_name=metric_name, forecast_id=forecast_id))
+    if not predictions:
+        logging.info('No forecasts to detect anomalies with')
+        return {}
+
+    points = compare_with_intervals(read_new_actuals(forecasts, last_actual_ds),
+                                    pd.concat(predictions, ignore_index=True))
+    anomalies = points[points['anomaly']]
+    normal_points = points[~points['anomaly']]
+
+    with connections.cursor_context('mara') as cursor:
+        if len(normal_points):
+            cursor.execute('DELETE FROM forecast_anomalies '
+                           'WHERE (metric_name, ds) IN (SELECT * FROM unnest(%s::TEXT[], %s::TIMESTAMP[]))',
+                           (normal_points['metric_name'].tolist(), normal_points['ds'].dt.to_pydatetime().tolist()))
+        if len(anomalies):
+            detected_ts = datetime.datetime.utcnow()
+            execute_values(
+                cursor,
+                'INSERT INTO forecast_anomalies'
+                '(metric_name, ds, forecast_id, y, yhat, yhat_lower, yhat_upper, deviation, detected_ts) VALUES %s '
+                'ON CONFLICT (metric_name, ds) DO UPDATE '
+                'SET forecast_id = EXCLUDED.forecast_id, y = EXCLUDED.y, yhat = EXCLUDED.yhat, '
+                'yhat_lower = EXCLUDED.yhat_lower, yhat_upper = EXCLUDED.yhat_upper, '
+                'deviation = EXCLUDED.deviation, detected_ts = EXCLUDED.detected_ts',
+                [(row.metric_name, row.ds.to_pydatetime(), int(row.forecast_id), float(row.y), float(row.yhat),
+                  float(row.yhat_lower), float(row.yhat_upper), float(row.deviation), detected_ts)
+                 for row in anomalies.itertuples(index=False)])
+
+    counts = anomalies['metric_name'].value_counts().to_dict()
+    logging.info(f'Compared {len(points)} new actuals of {len(last_actual_ds)} metrics, '
+                 f'found {len(anomalies)} anomalies')
+    return {forecasts[metric_name].metric_name: int(counts.get(metric_name, 0)) for metric_name in last_actual_ds}
@@ -0,0 +1,57 @@
+"""Command line interface for mara-prophet"""
+
+import click
+
+
+@click.command()
+@click.option('--keep-runs', type=int,
+              help='The number of latest runs per metric that are kept at full fidelity. '
+                   'Defaults to `config.forecast_retention_runs()`.')
+@click.option('--batch-size', type=int, default=50, show_default=True,
+              help='The number of forecast runs that are thinned per transaction.')
+def compact_forecasts(keep_runs: int, batch_size: int):
+    """Thins historized forecasts that are older than the latest runs of each metric"""
+    from mara_prophet import retention
+    click.echo(f'Compacted {retention.compact_forecasts(keep_runs, batch_size)} forecast runs')
+
+
+@click.command()
+@click.option('--concurrency', type=int,
+              help='The maximum number of forecasts running at the same time. Defaults to the number of CPUs.')
+@click.option('--poll-interval', type=float, default=5, show_default=True,
+              help='The number of seconds between looking for new jobs when the queue is empty.')
+@click.option('--max-jobs', type=int, help='Stop after having run this number of jobs.')
+def forecast_worker(concurrency: int, poll_interval: float, max_jobs: int):
+    """Runs queued forecast jobs until interrupted"""
+    from mara_prophet import jobs
+    jobs.run_worker(concurrency, poll_interval, max_jobs)
+
+
+@click.command()
+@click.argument('metric_names', nargs=-1)
+def enqueue_forecasts(metric_names: [str]):
+    """Queues forecast runs of metrics, of all configured forecasts when no metric name is given"""
+    import mara_prophet.config
+    from mara_prophet import jobs
+
+    metric_names = list(metric_names) or [forecast.metric_name for forecast in mara_prophet.config.forecasts()]
+    for metric_name, job_id in jobs.enqueue_forecasts(metric_names).items():
+        click.echo(f'{metric_name}: job {job_id}')
+
+
+@click.command()
+@click.option('--workers', type=int, help='The number of worker processes. Defaults to the number of CPUs.')
+@click.argument('metric_names', nargs=-1)
+def fill_forecast_intervals(workers: int, metric_names: [str]):
+    """Estimates the deferred uncertainty intervals of the latest forecasts"""
+    from mara_prophet import intervals
+    intervals.fill_forecast_intervals(list(metric_names) or None, workers)
+
+
+@click.command()
+@click.argument('metric_names', nargs=-1)
+def detect_anomalies(metric_names: [str]):
+    """Flags new actuals outside the uncertainty intervals of the latest forecasts"""
+    from mara_prophet import anomalies
+    for metric_name, count in anomalies.detect_anomalies(list(metric_names) or None).items():
+        click.echo(f'{metric_name}: {count} anomalies')
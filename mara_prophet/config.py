@@ -2,18 +2,100 @@
 Configures mara-prophet KPI-forecasting module
 """
 
+import typing
+
+if typing.TYPE_CHECKING:
+    import mara_prophet.serialization
+
 
 def db_alias():
     """The alias of the database that should be used when not specified otherwise"""
     return 'dwh-etl'
 
 
+def max_connections_per_pool() -> int:
+    """The maximum number of pooled connections per database alias and process"""
+    return 10
+
+
+def connection_pool_timeout() -> float:
+    """The number of seconds to wait for a pooled connection when all connections of a pool are in use"""
+    return 30
+
+
 def forecast_table_name():
     """An ETL integrated table name (str) for storing the forecasts.
     If None then no ETL-integration will take place"""
     return None
 
 
+def forecast_table_write_mode() -> str:
+    """How forecasts are written into the forecast table:
+    - 'replace': all existing rows of a metric are deleted before loading its new forecast
+    - 'upsert': only rows with the same (metric_date, metric_name) are overwritten"""
+    return 'replace'
+
+
+def forecast_table_timestamp_keyed() -> bool:
+    """When True, the forecast table is keyed by a `metric_ts TIMESTAMP` column instead of `metric_date DATE`,
+    as needed for hourly forecasts"""
+    return False
+
+
+def dataframe_codec() -> 'mara_prophet.serialization.DataFrameCodec':
+    """The codec for encoding the forecasts and source data frames stored in the 'mara' database"""
+    from mara_prophet.serialization import ParquetCodec
+    return ParquetCodec()
+
+
+def allow_pickle_deserialization() -> bool:
+    """Whether pickled data frames and figures as written by previous versions can be read from the 'mara' database.
+    Can be disabled after re-encoding them with `mara_prophet.serialization.migrate_stored_data()`"""
+    return True
+
+
+def deferred_intervals_niceness() -> int:
+    """The increment of the process niceness (lower priority) of workers estimating deferred uncertainty intervals"""
+    return 10
+
+
+def forecast_job_lease_seconds() -> int:
+    """
+    The number of seconds after which a running forecast job without a heartbeat of its worker is considered lost
+    (e.g. because the worker was killed) and marked as failed, so that the metric can be queued again
+    """
+    return 300
+
+
+def forecast_profile_dir() -> str:
+    """When set, each forecast run is profiled with cProfile and its stats are written to this directory"""
+    return None
+
+
+def main_plot_max_points() -> int:
+    """The maximum number of points plotted in the main forecast plot, longer series are downsampled.
+    Defaults to the width of the plot in pixels"""
+    return 1700
+
+
+def forecast_retention_runs() -> int:
+    """The number of latest runs per metric that are kept at full fidelity in the `forecasts` table
+    by `mara_prophet.retention.compact_forecasts()`, older runs are thinned to their predicted values.
+    When None, nothing is compacted"""
+    return 10
+
+
+def forecasts_per_page() -> int:
+    """The number of forecasts shown per page of the forecasts overview"""
+    return 10
+
+
+def client_side_rendering() -> bool:
+    """When True, the main forecast plots are drawn in the browser from the `/forecasts/_data/<name>` endpoint
+    instead of being rendered as images on the server"""
+    return False
+
+
 def forecasts() -> []:
     """A list with the forecast objects (and their configuration) to be run
 
@@ -0,0 +1,86 @@
+"""Per-process pools of PostgreSQL connections, one per database alias"""
+
+import contextlib
+import os
+import threading
+import typing
+
+import mara_db.dbs
+import mara_prophet.config
+
+if typing.TYPE_CHECKING:
+    import psycopg2.extensions
+    import psycopg2.pool
+
+_pools = {}
+_pool_slots = {}  # db alias -> semaphore that limits the connections in use to the size of the pool
+_pools_pid = None
+_inherited_pools = []
+_lock = threading.Lock()
+
+
+def connection_pool(db_alias: str) -> 'psycopg2.pool.ThreadedConnectionPool':
+    """The connection pool of a database alias in the current process"""
+    global _pools_pid
+    with _lock:
+        if _pools_pid != os.getpid():
+            # Connections inherited from a parent process share its sockets and must neither be used nor closed
+            # (closing them would terminate the parent's sessions), so they are only kept from being garbage collected
+            _inherited_pools.extend(_pools.values())
+            _pools.clear()
+            _pool_slots.clear()
+            _pools_pid = os.getpid()
+
+        if db_alias not in _pools:
+            import psycopg2.pool
+
+            db = mara_db.dbs.db(db_alias)
+            assert isinstance(db, mara_db.dbs.PostgreSQLDB), f'Database "{db_alias}" is not a PostgreSQL database'
+            _pools[db_alias] = psycopg2.pool.ThreadedConnectionPool(
+                0, mara_prophet.config.max_connections_per_pool(),
+                dbname=db.database, user=db.user, password=db.password, host=db.host, port=db.port,
+                sslmode=getattr(db, 'sslmode', None), sslrootcert=getattr(db, 'sslrootcert', None),
+                sslcert=getattr(db, 'sslcert', None), sslkey=getattr(db, 'sslkey', None))
+            _pool_slots[db_alias] = threading.BoundedSemaphore(mara_prophet.config.max_connections_per_pool())
+        return _pools[db_alias]
+
+
+@contextlib.contextmanager
+def cursor_context(db_alias: str) -> 'psycopg2.extensions.cursor':
+    """
+    Like `mara_db.postgresql.postgres_cursor_context`, but with a pooled connection:
+    the transaction is committed when the context is left without exception and rolled back otherwise.
+    When all connections of the pool are in use (e.g. by the threads of a web server), waits for one to be returned
+    """
+    import psycopg2.pool
+
+    pool = connection_pool(db_alias)
+    slots = _pool_slots[db_alias]
+    if not slots.acquire(timeout=mara_prophet.config.connection_pool_timeout()):
+        raise psycopg2.pool.PoolError(f'No connection of database "{db_alias}" became available within '
+                                      f'{mara_prophet.config.connection_pool_timeout()} seconds')
+    try:
+        connection = pool.getconn()
+        while connection.closed:
+            pool.putconn(connection, close=True)
+            connection = pool.getconn()
+
+        try:
+            with connection.cursor() as cursor:
+                yield cursor
+            connection.commit()
+        except Exception:
+            if not connection.closed:
+                connection.rollback()
+            raise
+        finally:
+            pool.putconn(connection, close=bool(connection.closed))
+    finally:
+        slots.release()
+
+
+def same_database(db_alias_1: str, db_alias_2: str) -> bool:
+    """Whether two database aliases point to the same PostgreSQL database (and can share transactions)"""
+    db_1, db_2 = mara_db.dbs.db(db_alias_1), mara_db.dbs.db(db_alias_2)
+    return all(getattr(db_1, attribute, None) == getattr(db_2, attribute, None)
+               for attribute in ['host', 'port', 'database', 'user'])
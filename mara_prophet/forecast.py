@@ -1,27 +1,34 @@
+import concurrent.futures
+import contextlib
+import hashlib
+import io
 import logging
-import sys
+import math
+import multiprocessing
+import multiprocessing.connection
 import json
+import tempfile
+import time
 
-import mara_db.postgresql
 import mara_db.auto_migration
 import mara_db.config
 import mara_prophet.config
-import numpy as np
-import pandas as pd
 
 import sqlalchemy
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.dialects.postgresql import JSONB
-import pickle
+from mara_prophet import connections, instrumentation, serialization
+from mara_prophet.instrumentation import RunMetrics
 from psycopg2 import Binary
 import datetime
+import typing
 
-Base = declarative_base()
-
-import matplotlib
+if typing.TYPE_CHECKING:
+    import pandas as pd
+    import psycopg2.extensions
+    from fbprophet import Prophet
 
-matplotlib.use('agg')
-from fbprophet import Prophet, forecaster
+Base = declarative_base()
 
 
 class ForecastBase(Base):
@@ -38,11 +45,29 @@ class ForecastBase(Base):
     forecasts_df = sqlalchemy.Column(sqlalchemy.LargeBinary)
     source_df = sqlalchemy.Column(sqlalchemy.LargeBinary)
     components_figure = sqlalchemy.Column(sqlalchemy.LargeBinary)
+    main_figure = sqlalchemy.Column(sqlalchemy.LargeBinary)
+    plot_series = sqlalchemy.Column(sqlalchemy.LargeBinary)
     hyper_parameters = sqlalchemy.Column(JSONB)
+    model_parameters = sqlalchemy.Column(JSONB)
+    source_fingerprint = sqlalchemy.Column(sqlalchemy.TEXT)
+    run_metrics = sqlalchemy.Column(JSONB)
+    intervals_pending = sqlalchemy.Column(sqlalchemy.Boolean)
 
     __table_args__ = (sqlalchemy.UniqueConstraint('metric_name', 'forecast_ts', name='forecasts_uk'),)
 
 
+class LatestForecastBase(Base):
+    """
+    Points to the latest run of each metric in `forecasts`, so that it can be looked up without scanning the history
+    """
+    __tablename__ = 'latest_forecasts'
+
+    metric_name = sqlalchemy.Column(sqlalchemy.TEXT, primary_key=True)
+    forecast_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('forecasts.id'), nullable=False)
+    forecast_ts = sqlalchemy.Column(sqlalchemy.DateTime(timezone=True), nullable=False)
+    modified_ts = sqlalchemy.Column(sqlalchemy.DateTime(timezone=True))  # e.g. when deferred intervals were added
+
+
 class Seasonality:
     def __init__(self, seasonality_mode='additive', seasonality_prior_scale=10.0, yearly_seasonality='auto',
                  weekly_seasonality='auto', daily_seasonality='auto'):
@@ -61,10 +86,68 @@ class Changepoint:
         self.changepoint_prior_scale = changepoint_prior_scale
 
 
+class OutputProfile:
+    def __init__(self, components: [str] = None, float32: bool = False):
+        """
+        Args:
+            components: Columns of the Prophet forecast that are kept in addition to ds, yhat, yhat_lower and
+                        yhat_upper, e.g. ['trend', 'weekly', 'yearly'] (at the log scale the model is fitted on)
+            float32: When True, the kept values are stored as 32 bit floats (about 7 significant digits)
+        """
+        self.components = components or []
+        self.float32 = float32
+
+    def columns(self) -> [str]:
+        """The columns of the Prophet forecast that are kept"""
+        return serialization.FORECASTS_DF_COLUMNS + [column for column in self.components
+                                                     if column not in serialization.FORECASTS_DF_COLUMNS]
+
+    def slim(self, forecast: 'pd.DataFrame') -> 'pd.DataFrame':
+        """A copy of a Prophet forecast with only the kept columns, in compact dtypes"""
+        import numpy as np
+
+        forecast = forecast[[column for column in self.columns() if column in forecast.columns]]
+        if self.float32:
+            forecast = forecast.astype({column: np.float32 for column in forecast.columns if column != 'ds'})
+        else:
+            forecast = forecast.copy()
+        return forecast
+
+
+# The pandas frequency and the length in days of a period per supported forecast frequency
+FREQUENCIES = {'hourly': ('H', 1 / 24), 'daily': ('D', 1), 'weekly': ('W-MON', 7)}
+
+
 class Forecast:
     def __init__(self, metric_name: str, number_of_days: int, time_series_query: str,
-                 growth: str = 'linear', holidays: pd.DataFrame = None, seasonality: Seasonality = Seasonality(),
-                 changepoint: Changepoint = Changepoint()) -> None:
+                 growth: str = 'linear', holidays: 'pd.DataFrame' = None, seasonality: Seasonality = Seasonality(),
+                 changepoint: Changepoint = Changepoint(), incremental: bool = False,
+                 use_tuned_parameters: bool = False, output: OutputProfile = OutputProfile(),
+                 frequency: str = 'daily', number_of_periods: int = None, uncertainty_samples: int = 1000,
+                 defer_intervals: bool = False) -> None:
+        """
+        Args:
+            metric_name: The name of the forecasted metric
+            number_of_days: The number of days to forecast
+            time_series_query: A query returning the historic time series as (ds, y) rows, one row per period
+            growth: 'linear' or 'logistic' trend
+            holidays: A data frame with the columns `holiday` and `ds` (and optionally `lower_window`, `upper_window`)
+            seasonality: The seasonality configuration of the model
+            changepoint: The trend changepoint configuration of the model
+            incremental: When True, the model is initialized with the parameters of the previous run of the metric
+                         and the run is skipped entirely when neither the source data nor the configuration changed
+            use_tuned_parameters: When True, the seasonality and changepoint settings are overridden with the
+                                  latest winner of `mara_prophet.tuning.tune_forecast` for the metric
+            output: The columns and dtypes of the forecast that are kept after plotting the components
+            frequency: The frequency of the time series, 'hourly', 'daily' or 'weekly' (with weeks starting on
+                       Mondays, as by `date_trunc('week', ...)`)
+            number_of_periods: The number of periods to forecast, overrides `number_of_days` when given
+            uncertainty_samples: The number of simulations for estimating the uncertainty intervals,
+                                 0 for point forecasts only (with empty bounds)
+            defer_intervals: When True, runs only compute point forecasts and the uncertainty intervals are added
+                             later by `mara_prophet.intervals.fill_forecast_intervals`
+        """
+        assert frequency in FREQUENCIES, f'Unknown frequency "{frequency}", expected one of {", ".join(FREQUENCIES)}'
         self.metric_name = metric_name
         self.number_of_days = number_of_days
         self.time_series_query = time_series_query
@@ -72,43 +155,36 @@ class Forecast:
         self.holidays = holidays
         self.seasonality = seasonality
         self.changepoint = changepoint
-
-    def read_data(self):
+        self.incremental = incremental
+        self.use_tuned_parameters = use_tuned_parameters
+        self.output = output
+        self.frequency = frequency
+        self.number_of_periods = number_of_periods
+        self.uncertainty_samples = uncertainty_samples
+        self.defer_intervals = defer_intervals
+
+    @property
+    def periods(self) -> int:
+        """The number of periods to forecast"""
+        if self.number_of_periods is not None:
+            return self.number_of_periods
+        return int(math.ceil(self.number_of_days / FREQUENCIES[self.frequency][1]))
+
+    def horizon_label(self) -> str:
+        """The forecast horizon for humans, e.g. '48 hours' or '12 weeks'"""
+        unit = {'hourly': 'hours', 'daily': 'days', 'weekly': 'weeks'}[self.frequency]
+        return f'{self.periods} {unit}'
+
+    def build_model(self, uncertainty_samples: int = None) -> 'Prophet':
         """
-        Read and log transform historic data
-        """
-        with mara_db.postgresql.postgres_cursor_context(mara_prophet.config.db_alias()) as cursor:
-            cursor.execute(f'''{self.time_series_query};''')
-            df = pd.DataFrame(cursor.fetchall(), columns=['ds', 'y'])
-
-        return df
+        Creates an unfitted Prophet model with the configuration of the forecast
 
-    def insert_into_table(self, forecast):
+        Args:
+            uncertainty_samples: Overrides the number of uncertainty samples of the forecast when given
         """
-        Insert historic and predict tables into forecast table
-        """
-        for index, row in forecast.iterrows():
-            with mara_db.postgresql.postgres_cursor_context(mara_prophet.config.db_alias()) as cursor:
-                cursor.execute(
-                    f"INSERT INTO {mara_prophet.config.forecast_table_name()} VALUES ({'%s, %s, %s, %s, %s'})",
-                    (row['ds'], self.metric_name, row['yhat'], row['yhat_lower'], row['yhat_upper']))
+        from fbprophet import Prophet
 
-    def forecast_metric(self):
-        """
-        Forecast the metric for the next {number_of_days} days
-        """
-        from mara_prophet.views import get_components_figure
-        np.warnings.filterwarnings('ignore')
-
-        logging_handler = logging.StreamHandler(sys.stdout)
-        logging_handler.setLevel(logging.DEBUG)
-        forecaster.logger.addHandler(logging_handler)
-
-        df = self.read_data()
-
-        df['y'] = np.log(df['y'])
-
-        m = Prophet(
+        return Prophet(
             growth=self.growth,
             holidays=self.holidays,
             seasonality_mode=self.seasonality.seasonality_mode,
@@ -119,95 +195,628 @@ class Forecast:
             changepoints=self.changepoint.changepoints,
             n_changepoints=self.changepoint.n_changepoints,
             changepoint_range=self.changepoint.changepoint_range,
-            changepoint_prior_scale=self.changepoint.changepoint_prior_scale
+            changepoint_prior_scale=self.changepoint.changepoint_prior_scale,
+            uncertainty_samples=self.uncertainty_samples if uncertainty_samples is None else uncertainty_samples
         )
 
-        m.fit(df)
-        future = m.make_future_dataframe(periods=self.number_of_days)
-        forecast = m.predict(future)
+    def source_fingerprint(self, df: 'pd.DataFrame') -> str:
+        """A hash of the source data and the configuration of the forecast, changes whenever a refit could differ"""
+        import pandas as pd
+
+        fingerprint = hashlib.sha256()
+        fingerprint.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+        fingerprint.update(json.dumps([self.frequency, self.periods, self.uncertainty_samples, self.growth,
+                                       vars(self.seasonality), vars(self.changepoint),
+                                       vars(self.output), self.defer_intervals], sort_keys=True, default=str).encode())
+        if self.holidays is not None:
+            fingerprint.update(pd.util.hash_pandas_object(self.holidays, index=False).values.tobytes())
+        return fingerprint.hexdigest()
+
+    def read_data(self) -> 'pd.DataFrame':
+        """
+        Read historic data ordered by date, streamed with `COPY ... TO STDOUT` into typed `ds` (datetime64)
+        and `y` (float64) columns
+        """
+        import numpy as np
+
+        df = read_query_into_dataframe(self.time_series_query, ['ds', 'y'], {'y': np.float64})
+        if not df['ds'].is_monotonic_increasing:
+            df = df.sort_values('ds', kind='mergesort').reset_index(drop=True)
+
+        return df
+
+    def forecast_table_rows(self, forecast: 'pd.DataFrame') -> 'pd.DataFrame':
+        """
+        The historic and predicted values of a prophet forecast as rows of the forecast table
+        """
+        import pandas as pd
 
-        # Data at original scale
-        forecast['yhat'] = np.exp(forecast['yhat'])
-        forecast['yhat_upper'] = np.exp(forecast['yhat_upper'])
-        forecast['yhat_lower'] = np.exp(forecast['yhat_lower'])
-        df['y'] = np.exp(df['y'])
+        return pd.DataFrame({forecast_table_key_column(): forecast['ds'],
+                             'metric_name': self.metric_name,
+                             'metric_value': forecast['yhat'],
+                             'lower_ci': forecast['yhat_lower'],
+                             'upper_ci': forecast['yhat_upper']})
 
-        if mara_prophet.config.forecast_table_name():
-            self.insert_into_table(forecast)
+    def insert_into_table(self, forecast, cursor: 'psycopg2.extensions.cursor' = None):
+        """
+        Bulk write historic and predicted values into the forecast table
+        """
+        write_forecasts_into_table(self.forecast_table_rows(forecast), cursor=cursor)
 
-        # Serialize source, forecast dataframes and components figure
+    def forecast_metric(self) -> dict:
+        """
+        Forecast the metric for the next {periods} periods
+
+        Returns:
+            The metrics of the run: `timings` in seconds per stage, `row_counts` and `byte_sizes` of the payloads
+        """
+        if self.frequency == 'hourly' and mara_prophet.config.forecast_table_name():
+            assert mara_prophet.config.forecast_table_timestamp_keyed(), \
+                f'Hourly forecast "{self.metric_name}" needs a timestamp keyed forecast table, ' \
+                f'see `config.forecast_table_timestamp_keyed()`'
+
+        run_metrics = RunMetrics()
+        with instrumentation.profiled(self.metric_name):
+            self._forecast_metric(run_metrics)
+
+        logging.info(f'Forecast run metrics of "{self.metric_name}": {json.dumps(run_metrics.as_dict())}')
+        return run_metrics.as_dict()
+
+    def _forecast_metric(self, run_metrics: RunMetrics):
+        import numpy as np
+        from fbprophet import forecaster
+        from mara_prophet.plot_data import build_plot_series
+        from mara_prophet.views import get_components_figure, get_main_plot_png
+        np.warnings.filterwarnings('ignore')
+
+        instrumentation.add_stdout_logging_handler(forecaster.logger)
+
+        metric_name = normalized_metric_name(self.metric_name)
+        historize = bool(mara_db.config.databases().get('mara'))
+        if historize:
+            ensure_mara_tables()
+
+        if self.use_tuned_parameters and historize:
+            from mara_prophet import tuning
+            self.seasonality, self.changepoint = tuning.tuned_settings(metric_name, self.seasonality,
+                                                                       self.changepoint)
+
+        with run_metrics.stage('query'):
+            df = self.read_data()
+        run_metrics.row_counts['source'] = len(df)
+
+        source_fingerprint = self.source_fingerprint(df)
+        previous_model_parameters = None
+        if self.incremental and historize:
+            with connections.cursor_context('mara') as cursor:
+                cursor.execute(f'''
+                SELECT source_fingerprint, model_parameters 
+                FROM latest_forecasts 
+                JOIN forecasts ON forecasts.id = latest_forecasts.forecast_id
+                WHERE latest_forecasts.metric_name = {'%s'}''', (metric_name,))
+                previous_fingerprint, previous_model_parameters = cursor.fetchone() or (None, None)
+
+            if previous_fingerprint == source_fingerprint:
+                logging.info(f'Source data and configuration of "{self.metric_name}" unchanged, skipping forecast')
+                return
+
+        with run_metrics.stage('log_transform'):
+            df['y'] = np.log(df['y'])
+
+        # deferred intervals are estimated later, which leaves most of the prediction time for other runs
+        uncertainty_samples = 0 if self.defer_intervals else None
+
+        with run_metrics.stage('fit'):
+            m = self.build_model(uncertainty_samples)
+            if previous_model_parameters:
+                try:
+                    # warm start the optimization from the parameters of the previous model
+                    m.fit(df, init=previous_model_parameters)
+                except Exception as e:
+                    logging.warning(f'Could not initialize "{self.metric_name}" with the previous model parameters '
+                                    f'({e}), fitting from scratch')
+                    m = self.build_model(uncertainty_samples)
+                    m.fit(df)
+            else:
+                m.fit(df)
+
+        with run_metrics.stage('predict'):
+            future = m.make_future_dataframe(periods=self.periods, freq=FREQUENCIES[self.frequency][0])
+            forecast = m.predict(future)
+            if 'yhat_lower' not in forecast:
+                # point forecasts only
+                forecast['yhat_lower'], forecast['yhat_upper'] = np.nan, np.nan
+        run_metrics.row_counts['forecast'] = len(forecast)
+
+        with run_metrics.stage('log_transform'):
+            # Data at original scale
+            forecast['yhat'] = np.exp(forecast['yhat'])
+            forecast['yhat_upper'] = np.exp(forecast['yhat_upper'])
+            forecast['yhat_lower'] = np.exp(forecast['yhat_lower'])
+            df['y'] = np.exp(df['y'])
+
+        # Serialize source, forecast dataframes, main and components figures
         # Mainly for accessing asynchronously at different front-ends directly from the 'mara' database
-        forecast_pickled = pickle.dumps(forecast)
-        source_data_pickled = pickle.dumps(df)
-        components_figure = get_components_figure(m, forecast)
-        components_figure_pickled = pickle.dumps(components_figure)
+        with run_metrics.stage('components_figure'):
+            components_figure = serialization.encode_figure(get_components_figure(m, forecast))
 
         # Save hyper parameters used by the model as JSON in mara-db
         hyper_parameters = json.dumps({
             'growth': m.growth,
             'holidays': [d['ds'].strftime('%Y-%m-%d') for d in
-                         m.holidays.to_dict('records')] if not m.holidays.empty else None,
+                         m.holidays.to_dict('records')] if m.holidays is not None and not m.holidays.empty else None,
+            # the complete holidays frame (names, windows and prior scales) for rebuilding the model
+            'holiday_events': [{name: value for name, value in event.items() if value is not None} for event in
+                               json.loads(m.holidays.assign(ds=m.holidays['ds'].dt.strftime('%Y-%m-%d'))
+                                          .to_json(orient='records'))]
+            if m.holidays is not None and not m.holidays.empty else None,
             'changepoint_prior_scale': m.changepoint_prior_scale,
             'changepoint_range': m.changepoint_range,
             'changepoints': [cp.strftime('%Y-%m-%d') for cp in
                              m.changepoints.to_list()] if not m.changepoints.empty else None,
+            'specified_changepoints': m.specified_changepoints,
             'n_changepoints': m.n_changepoints,
             'seasonality_mode': m.seasonality_mode,
             'seasonality_prior_scale': m.seasonality_prior_scale,
             'yearly_seasonality': m.yearly_seasonality,
             'weekly_seasonality': m.weekly_seasonality,
             'daily_seasonality': m.daily_seasonality,
-            'number_of_days': self.number_of_days
+            'number_of_days': self.number_of_days,
+            'frequency': self.frequency,
+            'periods': self.periods
+        })
+
+        # Save the fitted model parameters for warm starting subsequent runs
+        # (flattened, as Prophet sets 1-d parameters without fitting when the history is constant)
+        model_parameters = json.dumps({
+            **{name: float(np.ravel(m.params[name])[0]) for name in ['k', 'm', 'sigma_obs']},
+            **{name: np.ravel(m.params[name]).tolist() for name in ['delta', 'beta']}
         })
 
-        if mara_db.config.databases().get('mara'):
-            # Auto-migrate required mara-prophet internal forecasts table
-            mara_db.auto_migration.auto_discover_models_and_migrate()
+        # Only the columns of the output profile are needed from here on,
+        # the full Prophet frame (with every seasonal term and its bounds) and the model are released right away
+        with run_metrics.stage('slim'):
+            run_metrics.byte_sizes['full_forecast_memory'] = int(forecast.memory_usage(deep=True).sum())
+            forecast = self.output.slim(forecast)
+            del m
+            run_metrics.byte_sizes['forecast_memory'] = int(forecast.memory_usage(deep=True).sum())
+
+        with run_metrics.stage('main_figure'):
+            plot_series = build_plot_series(df, forecast)
+            main_figure = serialization.encode_figure(get_main_plot_png(metric_name, plot_series))
+        with run_metrics.stage('serialize'):
+            forecast_encoded = serialization.encode_dataframe(forecast)
+            source_data_encoded = serialization.encode_dataframe(df)
+            plot_series_encoded = serialization.encode_dataframe(plot_series)
+        del df, plot_series
+
+        run_metrics.byte_sizes.update({'forecasts_df': len(forecast_encoded),
+                                       'source_df': len(source_data_encoded),
+                                       'plot_series': len(plot_series_encoded),
+                                       'components_figure': len(components_figure),
+                                       'main_figure': len(main_figure)})
+
+        # the run metrics are serialized when the run is stored, so that they cover all stages up to the insert
+        historized_run = (metric_name,
+                          datetime.datetime.utcnow(),
+                          forecast_encoded,
+                          source_data_encoded,
+                          plot_series_encoded,
+                          components_figure,
+                          main_figure,
+                          hyper_parameters,
+                          model_parameters,
+                          source_fingerprint,
+                          run_metrics,
+                          self.defer_intervals and self.uncertainty_samples > 0) if historize else None
+        self.persist(forecast, historized_run, run_metrics)
+
+    def persist(self, forecast: 'pd.DataFrame', historized_run: tuple, run_metrics: RunMetrics):
+        """
+        Writes the forecast into the forecast table and historizes the run, see `write_forecast_runs`
+
+        Args:
+            forecast: The slim forecast
+            historized_run: The values of the `forecasts` row, None when the 'mara' database is not configured
+            run_metrics: The metrics of the run
+        """
+        write_forecast_runs(self.forecast_table_rows(forecast) if mara_prophet.config.forecast_table_name() else None,
+                            [historized_run] if historized_run else [], run_metrics)
+
+
+class BreakdownForecast(Forecast):
+    """
+    Forecasts a metric per group (e.g. per country) from a single query returning (ds, group_key, y) rows,
+    see `mara_prophet.sql.build_grouped_time_series_sql_query`.
+
+    One model per group is fitted in parallel worker processes and historized as metric "<metric_name> (<group_key>)".
+    The forecast table rows and the historized runs of all groups are written at once, after all groups have been
+    fitted.
+    The uncertainty intervals of groups are estimated right away, `defer_intervals` is not supported.
+    """
+
+    def __init__(self, *args, workers: int = None, **kwargs) -> None:
+        """
+        Args:
+            workers: The maximum number of worker processes for fitting the groups, defaults to the number of CPUs
+        """
+        super().__init__(*args, **kwargs)
+        self.workers = workers
 
-            with mara_db.postgresql.postgres_cursor_context('mara') as cursor:
-                cursor.execute(
-                    f"INSERT INTO forecasts(metric_name, forecast_ts, forecasts_df, "
-                    f"source_df, components_figure, hyper_parameters) "
-                    f"VALUES ({'%s, %s, %s, %s, %s, %s'})",
-                    (str(self.metric_name).lower().replace(' ', '_').replace('-', '_'),
-                     datetime.datetime.utcnow(),
-                     Binary(forecast_pickled),
-                     Binary(source_data_pickled),
-                     Binary(components_figure_pickled),
-                     hyper_parameters))
+    def group_metric_name(self, group_key: str) -> str:
+        """The metric name of the forecast of a single group"""
+        return f'{self.metric_name} ({group_key})'
+
+    def read_data(self) -> 'pd.DataFrame':
+        """
+        Read historic data of all groups ordered by group and date
+        """
+        import numpy as np
+
+        df = read_query_into_dataframe(self.time_series_query, ['ds', 'group_key', 'y'],
+                                       {'group_key': str, 'y': np.float64})
+        return df.sort_values(['group_key', 'ds'], kind='mergesort').reset_index(drop=True)
+
+    def _forecast_metric(self, run_metrics: RunMetrics):
+        """
+        Forecast the metric of each group, the run metrics of all groups are added up
+        """
+        import pandas as pd
+
+        with run_metrics.stage('query'):
+            df = self.read_data()
+        run_metrics.row_counts['source'] = len(df)
+
+        group_forecasts = [_BreakdownGroupForecast(self, group_key, group_df)
+                           for group_key, group_df in df.groupby('group_key', sort=False)]
+        del df
+
+        forecast_table_rows = []
+        historized_runs = []
+        failed_groups = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(_forecast_breakdown_group, group_forecast): group_forecast.metric_name
+                       for group_forecast in group_forecasts}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    group_run_metrics, group_rows, group_historized_run = future.result()
+                except Exception as e:
+                    logging.error(f'Forecast of "{futures[future]}" failed: {e!r}')
+                    failed_groups.append(futures[future])
+                    continue
+                group_run_metrics['timings'].pop('query', None)
+                group_run_metrics['row_counts'].pop('source', None)
+                run_metrics.add(group_run_metrics)
+                if group_rows is not None:
+                    forecast_table_rows.append(group_rows)
+                if group_historized_run is not None:
+                    historized_runs.append(group_historized_run)
+
+        # the groups that succeeded are written in one transaction (per database)
+        write_forecast_runs(pd.concat(forecast_table_rows, ignore_index=True) if forecast_table_rows else None,
+                            historized_runs, run_metrics)
+
+        if failed_groups:
+            raise Exception(f'Forecasts of {len(failed_groups)} groups failed: {", ".join(failed_groups)}')
+
+
+class _BreakdownGroupForecast(Forecast):
+    """The forecast of a single group of a breakdown forecast, with the data already read"""
+
+    def __init__(self, breakdown: BreakdownForecast, group_key: str, df: 'pd.DataFrame') -> None:
+        super().__init__(metric_name=breakdown.group_metric_name(group_key),
+                         number_of_days=breakdown.number_of_days,
+                         time_series_query=breakdown.time_series_query,
+                         growth=breakdown.growth,
+                         holidays=breakdown.holidays,
+                         seasonality=breakdown.seasonality,
+                         changepoint=breakdown.changepoint,
+                         incremental=breakdown.incremental,
+                         use_tuned_parameters=breakdown.use_tuned_parameters,
+                         output=breakdown.output,
+                         uncertainty_samples=breakdown.uncertainty_samples,
+                         frequency=breakdown.frequency,
+                         number_of_periods=breakdown.number_of_periods)
+        self.df = df[['ds', 'y']].reset_index(drop=True)
+        self.rows = None
+        self.historized_run = None
+
+    def read_data(self) -> 'pd.DataFrame':
+        return self.df.copy()
+
+    def persist(self, forecast: 'pd.DataFrame', historized_run: tuple, run_metrics: RunMetrics):
+        # collected by the breakdown forecast for a single write of all groups
+        self.rows = self.forecast_table_rows(forecast) if mara_prophet.config.forecast_table_name() else None
+        self.historized_run = historized_run
+
+
+def _forecast_breakdown_group(group_forecast: _BreakdownGroupForecast) -> (dict, 'pd.DataFrame', tuple):
+    """Runs the forecast of a single group in a worker process"""
+    run_metrics = group_forecast.forecast_metric()
+    return run_metrics, group_forecast.rows, group_forecast.historized_run
+
+
+def read_query_into_dataframe(query: str, names: [str], dtype: dict) -> 'pd.DataFrame':
+    """
+    Streams the result of a query in the etl database with `COPY ... TO STDOUT` into a data frame,
+    spilling to disk for very long results instead of holding the whole CSV in memory
+
+    Args:
+        query: A SELECT statement whose first column is `ds`
+        names: The names of the columns of the result
+        dtype: The types of the columns other than `ds`, which is parsed as datetime64
+    """
+    import pandas as pd
+
+    with tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024) as buffer:
+        with connections.cursor_context(mara_prophet.config.db_alias()) as cursor:
+            cursor.copy_expert(f"COPY ({query.strip().rstrip(';')}) TO STDOUT WITH CSV", buffer)
+        buffer.seek(0)
+        return pd.read_csv(buffer, names=names, header=None, dtype=dtype, parse_dates=['ds'])
+
+
+def write_forecast_runs(forecast_table_rows: 'pd.DataFrame', historized_runs: [tuple], run_metrics: RunMetrics):
+    """
+    Writes forecast table rows and historized runs together: a failure of either write rolls back both
+    (and when both aliases point to the same database, they share a single transaction).
+    Each run becomes the latest of its metric, unless a later run has been stored meanwhile
+
+    Args:
+        forecast_table_rows: The rows for the forecast table, None when it is not configured
+        historized_runs: The values of `forecasts` rows, with plain bytes (that can be sent between processes)
+                         and the run metrics serialized at insert time
+        run_metrics: Receives the durations of the `etl_insert` and `mara_insert` stages
+    """
+    if forecast_table_rows is None and not historized_runs:
+        return
+
+    with contextlib.ExitStack() as transactions:
+        etl_cursor, mara_cursor = None, None
+        if forecast_table_rows is not None:
+            etl_cursor = transactions.enter_context(connections.cursor_context(mara_prophet.config.db_alias()))
+        if historized_runs:
+            if etl_cursor and connections.same_database(mara_prophet.config.db_alias(), 'mara'):
+                mara_cursor = etl_cursor
+            else:
+                mara_cursor = transactions.enter_context(connections.cursor_context('mara'))
+
+        if etl_cursor:
+            with run_metrics.stage('etl_insert'):
+                write_forecasts_into_table(forecast_table_rows, cursor=etl_cursor)
+
+        if mara_cursor:
+            with run_metrics.stage('mara_insert'):
+                for historized_run in historized_runs:
+                    mara_cursor.execute(
+                        f"WITH inserted AS ("
+                        f"  INSERT INTO forecasts(metric_name, forecast_ts, forecasts_df, "
+                        f"  source_df, plot_series, components_figure, main_figure, hyper_parameters, "
+                        f"  model_parameters, source_fingerprint, run_metrics, intervals_pending) "
+                        f"  VALUES ({'%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s'}) "
+                        f"  RETURNING id, metric_name, forecast_ts) "
+                        f"INSERT INTO latest_forecasts(metric_name, forecast_id, forecast_ts, modified_ts) "
+                        f"SELECT metric_name, id, forecast_ts, forecast_ts FROM inserted "
+                        f"ON CONFLICT (metric_name) DO UPDATE "
+                        f"SET forecast_id = EXCLUDED.forecast_id, forecast_ts = EXCLUDED.forecast_ts, "
+                        f"modified_ts = EXCLUDED.modified_ts "
+                        f"WHERE latest_forecasts.forecast_ts <= EXCLUDED.forecast_ts",
+                        [json.dumps(value.as_dict()) if isinstance(value, RunMetrics)
+                         else Binary(value) if isinstance(value, bytes) else value
+                         for value in historized_run])
+
+
+def forecast_table_key_column() -> str:
+    """The time column of the forecast table: `metric_ts` when timestamp keyed, `metric_date` otherwise"""
+    return 'metric_ts' if mara_prophet.config.forecast_table_timestamp_keyed() else 'metric_date'
 
 
 def create_forecast_table():
     """
     Drop and create the forecast table in mara and custom dbs
     """
-    with mara_db.postgresql.postgres_cursor_context(mara_prophet.config.db_alias()) as cursor:
+    key_column = forecast_table_key_column()
+    key_type = 'TIMESTAMP' if mara_prophet.config.forecast_table_timestamp_keyed() else 'DATE'
+    with connections.cursor_context(mara_prophet.config.db_alias()) as cursor:
         cursor.execute(f"DROP TABLE IF EXISTS {mara_prophet.config.forecast_table_name()};"
                        f"CREATE TABLE {mara_prophet.config.forecast_table_name()} "
-                       f"(metric_date DATE, metric_name TEXT, metric_value DOUBLE PRECISION,"
+                       f"({key_column} {key_type}, metric_name TEXT, metric_value DOUBLE PRECISION,"
                        f"lower_ci DOUBLE PRECISION, upper_ci DOUBLE PRECISION );"
                        f"ALTER TABLE {mara_prophet.config.forecast_table_name()} "
-                       f"ADD PRIMARY KEY (metric_date, metric_name) ")
+                       f"ADD PRIMARY KEY ({key_column}, metric_name) ")
     return True
 
 
+_mara_tables_ready = False
+
+
+def create_mara_tables():
+    """
+    One time creation (or migration) of the mara-prophet internal tables in the 'mara' database
+    """
+    mara_db.auto_migration.auto_discover_models_and_migrate()
+
+    # point to the latest runs of metrics that have been forecasted before the pointer table existed
+    with connections.cursor_context('mara') as cursor:
+        cursor.execute('''
+        INSERT INTO latest_forecasts(metric_name, forecast_id, forecast_ts, modified_ts)
+        SELECT DISTINCT ON (metric_name) metric_name, id, forecast_ts, forecast_ts
+        FROM forecasts
+        ORDER BY metric_name, forecast_ts DESC
+        ON CONFLICT (metric_name) DO NOTHING''')
+
+    global _mara_tables_ready
+    _mara_tables_ready = True
+    return True
+
+
+def ensure_mara_tables():
+    """
+    Creates or migrates the mara-prophet internal tables when any of their columns is missing.
+    Checked with a single catalog query once per process, so that persisting forecasts does not auto-migrate
+    """
+    global _mara_tables_ready
+    if _mara_tables_ready:
+        return
+
+    import mara_prophet
+    tables = [model.__table__ for model in mara_prophet.MARA_AUTOMIGRATE_SQLALCHEMY_MODELS()]
+
+    with connections.cursor_context('mara') as cursor:
+        cursor.execute('''
+        SELECT table_name, column_name 
+        FROM information_schema.columns 
+        WHERE table_schema = current_schema() AND table_name = ANY(%s)''', ([table.name for table in tables],))
+        existing_columns = set(cursor.fetchall())
+
+    if not all((table.name, column.name) in existing_columns for table in tables for column in table.columns):
+        logging.info('Migrating mara-prophet tables')
+        create_mara_tables()
+    _mara_tables_ready = True
+
+
+def write_forecasts_into_table(forecasts_df: 'pd.DataFrame', mode: str = None,
+                               cursor: 'psycopg2.extensions.cursor' = None):
+    """
+    Streams forecasts into the forecast table with a single `COPY ... FROM STDIN` in one transaction
+
+    Args:
+        forecasts_df: A data frame with the columns of the forecast table (metric_date or metric_ts, metric_name,
+                      metric_value, lower_ci, upper_ci), can contain multiple metrics
+        mode: 'replace' deletes all existing rows of the contained metrics before loading,
+              'upsert' only overwrites rows with the same (metric_date or metric_ts, metric_name).
+              Defaults to `config.forecast_table_write_mode()`
+        cursor: When given, the rows are written within the transaction of this cursor
+    """
+    if cursor is None:
+        with connections.cursor_context(mara_prophet.config.db_alias()) as cursor:
+            return write_forecasts_into_table(forecasts_df, mode, cursor)
+
+    mode = mode or mara_prophet.config.forecast_table_write_mode()
+    assert mode in ('replace', 'upsert'), f'Unknown forecast table write mode "{mode}"'
+
+    table_name = mara_prophet.config.forecast_table_name()
+    key_column = forecast_table_key_column()
+    columns = [key_column, 'metric_name', 'metric_value', 'lower_ci', 'upper_ci']
+
+    buffer = io.StringIO()
+    forecasts_df.to_csv(buffer, columns=columns, header=False, index=False,
+                        date_format='%Y-%m-%d %H:%M:%S' if key_column == 'metric_ts' else '%Y-%m-%d')
+    buffer.seek(0)
+
+    if mode == 'replace':
+        cursor.execute(f"DELETE FROM {table_name} WHERE metric_name = ANY(%s)",
+                       (forecasts_df['metric_name'].unique().tolist(),))
+        cursor.copy_expert(f"COPY {table_name} ({', '.join(columns)}) FROM STDIN WITH CSV", buffer)
+    else:
+        cursor.execute(f"CREATE TEMPORARY TABLE forecast_staging (LIKE {table_name}) ON COMMIT DROP")
+        cursor.copy_expert(f"COPY forecast_staging ({', '.join(columns)}) FROM STDIN WITH CSV", buffer)
+        cursor.execute(f"INSERT INTO {table_name} ({', '.join(columns)}) "
+                       f"SELECT {', '.join(columns)} FROM forecast_staging "
+                       f"ON CONFLICT ({key_column}, metric_name) DO UPDATE "
+                       f"SET metric_value = EXCLUDED.metric_value, "
+                       f"lower_ci = EXCLUDED.lower_ci, upper_ci = EXCLUDED.upper_ci")
+
+
+def forecasts_by_name() -> {str: Forecast}:
+    """The configured forecasts indexed by their metric name"""
+    return {forecast.metric_name: forecast for forecast in mara_prophet.config.forecasts()}
+
+
+def normalized_metric_name(metric_name: str) -> str:
+    """The name of a metric as stored in the 'mara' database tables and used in urls, e.g. 'daily_orders'"""
+    return str(metric_name).lower().replace(' ', '_').replace('-', '_')
+
+
 def run_forecast(metric_name: str):
     """
     Runs a time-series analysis for a Forecast object
     """
-    handler = logging.StreamHandler(sys.stdout)
-    handler.setLevel(logging.DEBUG)
-    logging.getLogger().addHandler(handler)
-    forecast = None
-    for f in mara_prophet.config.forecasts():
-        if f.metric_name == metric_name:
-            forecast = f
-            break
+    instrumentation.add_stdout_logging_handler(logging.getLogger())
+    forecast = forecasts_by_name().get(metric_name)
     if forecast:
         logging.info('Running forecast for metric: ' + forecast.metric_name)
-        logging.info('Number of days: ' + str(forecast.number_of_days))
+        logging.info('Horizon: ' + forecast.horizon_label())
         logging.info('Time series query: ' + forecast.time_series_query)
         forecast.forecast_metric()
     else:
         logging.warning('Oops, there is no defined forecast with name "{metric_name}".')
     return True
+
+
+def run_forecasts(metric_names: [str] = None, workers: int = None, timeout: int = None) -> {str: dict}:
+    """
+    Runs the time-series analyses of multiple metrics in parallel, each one in its own worker process
+
+    Args:
+        metric_names: The metrics to forecast, all configured forecasts when not specified
+        workers: The maximum number of concurrent worker processes, defaults to the number of CPUs
+        timeout: The maximum number of seconds a single metric forecast may take before its worker is terminated
+
+    Returns:
+        A summary per metric name with `succeeded`, the `error` of failed runs and the `timings` in seconds
+        of each stage, `row_counts` and `byte_sizes` of successful runs
+    """
+    instrumentation.add_stdout_logging_handler(logging.getLogger())
+    forecasts = forecasts_by_name()
+    metric_names = list(forecasts.keys()) if metric_names is None else list(metric_names)
+    workers = workers or multiprocessing.cpu_count()
+
+    summary = {}
+    for metric_name in metric_names:
+        if metric_name not in forecasts:
+            logging.warning(f'Oops, there is no defined forecast with name "{metric_name}".')
+            summary[metric_name] = {'succeeded': False, 'error': 'No defined forecast with this name'}
+
+    pending = [metric_name for metric_name in metric_names if metric_name in forecasts]
+    running = {}  # metric name -> (process, result connection, start time)
+
+    while pending or running:
+        while pending and len(running) < workers:
+            metric_name = pending.pop(0)
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_forecast_metric_in_worker,
+                                              args=(forecasts[metric_name], sender),
+                                              name=f'forecast-{metric_name}')
+            process.start()
+            sender.close()
+            running[metric_name] = (process, receiver, time.monotonic())
+
+        multiprocessing.connection.wait([receiver for _, receiver, _ in running.values()], timeout=1)
+
+        for metric_name, (process, receiver, start_time) in list(running.items()):
+            if receiver.poll():
+                try:
+                    summary[metric_name] = receiver.recv()
+                except EOFError:
+                    process.join()
+                    summary[metric_name] = {'succeeded': False,
+                                            'error': f'Worker exited with code {process.exitcode}'}
+            elif timeout and time.monotonic() - start_time > timeout:
+                process.terminate()
+                summary[metric_name] = {'succeeded': False, 'error': f'Timed out after {timeout} seconds'}
+            else:
+                continue
+
+            process.join()
+            receiver.close()
+            del running[metric_name]
+
+            if summary[metric_name]['succeeded']:
+                logging.info(f'Forecast of "{metric_name}" succeeded: ' + ', '.join(
+                    f'{stage} {duration:.1f}s' for stage, duration in summary[metric_name]['timings'].items()))
+            else:
+                logging.error(f'Forecast of "{metric_name}" failed: {summary[metric_name]["error"]}')
+
+    return summary
+
+
+def _forecast_metric_in_worker(forecast: Forecast, connection: multiprocessing.connection.Connection):
+    """Runs a single forecast in a worker process and sends its outcome back through `connection`"""
+    try:
+        run_metrics = forecast.forecast_metric()
+        connection.send({'succeeded': True, **run_metrics})
+    except Exception as e:
+        logging.exception(f'Forecast of "{forecast.metric_name}" failed')
+        connection.send({'succeeded': False, 'error': repr(e)})
+    finally:
+        connection.close()
@@ -0,0 +1,72 @@
+"""Timings, sizes, profiling and logging of forecast runs"""
+
+import contextlib
+import cProfile
+import datetime
+import logging
+import os
+import sys
+import time
+
+import mara_prophet.config
+
+
+class RunMetrics:
+    """Durations, row counts and payload sizes of the stages of a forecast run"""
+
+    def __init__(self):
+        self.timings = {}
+        self.row_counts = {}
+        self.byte_sizes = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """Measures the duration of a stage, durations of repeated stages add up"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0) + time.monotonic() - start
+
+    def add(self, run_metrics: dict):
+        """Adds up the metrics of another run, e.g. of a single group of a breakdown forecast"""
+        for attribute in ['timings', 'row_counts', 'byte_sizes']:
+            for key, value in run_metrics.get(attribute, {}).items():
+                getattr(self, attribute)[key] = getattr(self, attribute).get(key, 0) + value
+
+    def as_dict(self) -> dict:
+        return {'timings': {stage: round(duration, 4) for stage, duration in self.timings.items()},
+                'row_counts': dict(self.row_counts),
+                'byte_sizes': dict(self.byte_sizes)}
+
+
+@contextlib.contextmanager
+def profiled(name: str):
+    """
+    Profiles the enclosed code with cProfile when `config.forecast_profile_dir()` is set,
+    writing the stats to `<forecast_profile_dir>/<name>-<timestamp>.prof` (for e.g. snakeviz or pstats)
+    """
+    profile_dir = mara_prophet.config.forecast_profile_dir()
+    if not profile_dir:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(profile_dir, exist_ok=True)
+        file_name = os.path.join(profile_dir, f'{name}-{datetime.datetime.utcnow():%Y%m%dT%H%M%S}.prof')
+        profiler.dump_stats(file_name)
+        logging.info(f'Wrote profile of "{name}" to {file_name}')
+
+
+def add_stdout_logging_handler(logger: logging.Logger):
+    """Logs to stdout, adding the handler only once per logger also when called repeatedly in a long-lived process"""
+    if not any(getattr(handler, 'mara_prophet_stdout', False) for handler in logger.handlers):
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setLevel(logging.DEBUG)
+        handler.mara_prophet_stdout = True
+        logger.addHandler(handler)
@@ -0,0 +1,145 @@
+"""Deferred estimation of the uncertainty intervals of point forecasts, at a lower process priority"""
+
+import concurrent.futures
+import contextlib
+import datetime
+import logging
+import os
+
+import mara_prophet.config
+from mara_prophet import connections, instrumentation, serialization
+from psycopg2 import Binary
+
+_priority_lowered = False
+
+
+def _lower_priority():
+    """Lowers the scheduling priority of the current (worker) process once, so that point forecasts go first"""
+    global _priority_lowered
+    if not _priority_lowered and mara_prophet.config.deferred_intervals_niceness():
+        os.nice(mara_prophet.config.deferred_intervals_niceness())
+    _priority_lowered = True
+
+
+def fill_forecast_intervals(metric_names: [str] = None, workers: int = None) -> {str: bool}:
+    """
+    Estimates the uncertainty intervals of the latest runs of forecasts with `defer_intervals=True`
+    and adds them to the historized forecast and the forecast table
+
+    Args:
+        metric_names: The metrics to estimate intervals for, all configured forecasts with deferred intervals
+                      when not given
+        workers: The number of worker processes, defaults to the number of CPUs
+
+    Returns:
+        Whether the intervals could be added per metric name
+    """
+    from mara_prophet.forecast import ensure_mara_tables, forecasts_by_name, normalized_metric_name
+
+    instrumentation.add_stdout_logging_handler(logging.getLogger())
+    ensure_mara_tables()
+
+    forecasts = forecasts_by_name()
+    if metric_names is None:
+        metric_names = [metric_name for metric_name, forecast in forecasts.items() if forecast.defer_intervals]
+    forecasts = {normalized_metric_name(metric_name): forecasts[metric_name]
+                 for metric_name in metric_names if metric_name in forecasts}
+
+    with connections.cursor_context('mara') as cursor:
+        cursor.execute('''
+        SELECT latest_forecasts.metric_name, forecast_id
+        FROM latest_forecasts
+        JOIN forecasts ON forecasts.id = latest_forecasts.forecast_id
+        WHERE latest_forecasts.metric_name = ANY(%s) AND forecasts.intervals_pending''', (list(forecasts.keys()),))
+        pending = dict(cursor.fetchall())
+
+    logging.info(f'Estimating uncertainty intervals of {len(pending)} forecasts')
+    succeeded = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_fill_intervals, forecasts[metric_name], forecast_id): metric_name
+                   for metric_name, forecast_id in pending.items()}
+        for future in concurrent.futures.as_completed(futures):
+            metric_name = futures[future]
+            try:
+                future.result()
+                succeeded[forecasts[metric_name].metric_name] = True
+            except Exception as e:
+                logging.error(f'Could not estimate the uncertainty intervals of "{metric_name}": {e!r}')
+                succeeded[forecasts[metric_name].metric_name] = False
+    return succeeded
+
+
+def _fill_intervals(forecast: 'mara_prophet.forecast.Forecast', forecast_id: int):
+    """Refits the model of a point forecast run, warm started from its parameters, and predicts with intervals"""
+    import numpy as np
+    from mara_prophet.plot_data import build_plot_series
+    from mara_prophet.forecast import FREQUENCIES
+    from mara_prophet.validation import build_model
+    from mara_prophet.views import get_components_figure, get_main_plot_png
+
+    _lower_priority()
+    np.warnings.filterwarnings('ignore')
+
+    with connections.cursor_context('mara') as cursor:
+        cursor.execute('SELECT metric_name, source_df, forecasts_df, hyper_parameters, model_parameters '
+                       'FROM forecasts WHERE id = %s', (forecast_id,))
+        metric_name, source_df, forecasts_df, hyper_parameters, model_parameters = cursor.fetchone()
+
+    df = serialization.decode_dataframe(source_df)
+    df['y'] = np.log(df['y'])
+
+    # the model is rebuilt from the stored settings of the point forecast run (including tuned parameters), so that
+    # the intervals belong to the predicted values. The optimization starts at the optimum of that run,
+    # so this fit converges right away
+    m = build_model(hyper_parameters, uncertainty_samples=forecast.uncertainty_samples)
+    if model_parameters:
+        try:
+            m.fit(df, init=model_parameters)
+        except Exception as e:
+            logging.warning(f'Could not initialize "{forecast.metric_name}" with the parameters of the point forecast '
+                            f'({e}), fitting from scratch')
+            m = build_model(hyper_parameters, uncertainty_samples=forecast.uncertainty_samples)
+            m.fit(df)
+    else:
+        m.fit(df)
+    full_forecast = m.predict(m.make_future_dataframe(periods=forecast.periods,
+                                                      freq=FREQUENCIES[forecast.frequency][0]))
+    components_figure = serialization.encode_figure(get_components_figure(m, full_forecast))
+    del m
+
+    bounds = full_forecast[['ds']].assign(yhat_lower=np.exp(full_forecast['yhat_lower']),
+                                          yhat_upper=np.exp(full_forecast['yhat_upper']))
+    del full_forecast
+    point_forecast = serialization.decode_dataframe(forecasts_df)
+    forecast_df = forecast.output.slim(
+        point_forecast.drop(columns=['yhat_lower', 'yhat_upper']).merge(bounds, on='ds', how='left'))
+
+    df['y'] = np.exp(df['y'])
+    plot_series = build_plot_series(df, forecast_df)
+    main_figure = serialization.encode_figure(get_main_plot_png(metric_name, plot_series))
+
+    # the historized run and (when it still is the latest run) the forecast table are updated together
+    with contextlib.ExitStack() as transactions:
+        mara_cursor = transactions.enter_context(connections.cursor_context('mara'))
+        mara_cursor.execute(
+            f"UPDATE forecasts SET forecasts_df = {'%s'}, plot_series = {'%s'}, components_figure = {'%s'}, "
+            f"main_figure = {'%s'}, intervals_pending = FALSE "
+            f"WHERE id = {'%s'} AND intervals_pending",
+            (Binary(serialization.encode_dataframe(forecast_df)),
+             Binary(serialization.encode_dataframe(plot_series)),
+             Binary(components_figure), Binary(main_figure), forecast_id))
+        if not mara_cursor.rowcount:
+            logging.info(f'The intervals of "{forecast.metric_name}" have been added meanwhile')
+            return
+        mara_cursor.execute(f"UPDATE latest_forecasts SET modified_ts = {'%s'} WHERE forecast_id = {'%s'}",
+                            (datetime.datetime.utcnow(), forecast_id))
+        is_latest = mara_cursor.rowcount > 0
+
+        if is_latest and mara_prophet.config.forecast_table_name():
+            if connections.same_database(mara_prophet.config.db_alias(), 'mara'):
+                etl_cursor = mara_cursor
+            else:
+                etl_cursor = transactions.enter_context(connections.cursor_context(mara_prophet.config.db_alias()))
+            forecast.insert_into_table(forecast_df, etl_cursor)
+
+    logging.info(f'Added uncertainty intervals to the forecast of "{forecast.metric_name}"')
@@ -0,0 +1,262 @@
+"""A queue of forecast runs in the 'mara' database, processed by any number of worker processes"""
+
+import concurrent.futures
+import datetime
+import json
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+import mara_prophet.config
+from mara_prophet import connections, instrumentation
+import sqlalchemy
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.declarative import declarative_base
+
+Base = declarative_base()
+
+QUEUED, RUNNING, SUCCEEDED, FAILED = 'queued', 'running', 'succeeded', 'failed'
+
+
+class ForecastJobBase(Base):
+    """
+    Stores requested forecast runs and their progress: jobs are 'queued' until a worker claims them as 'running',
+    and end up 'succeeded' (with the metrics of the run) or 'failed' (with the error). Workers renew the
+    `heartbeat_ts` of their running jobs, jobs without a recent heartbeat are failed as lost
+    """
+    __tablename__ = 'forecast_jobs'
+
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    metric_name = sqlalchemy.Column(sqlalchemy.TEXT, nullable=False)
+    state = sqlalchemy.Column(sqlalchemy.TEXT, nullable=False)
+    enqueued_ts = sqlalchemy.Column(sqlalchemy.DateTime(timezone=True), nullable=False)
+    started_ts = sqlalchemy.Column(sqlalchemy.DateTime(timezone=True))
+    finished_ts = sqlalchemy.Column(sqlalchemy.DateTime(timezone=True))
+    worker = sqlalchemy.Column(sqlalchemy.TEXT)
+    heartbeat_ts = sqlalchemy.Column(sqlalchemy.DateTime(timezone=True))
+    error = sqlalchemy.Column(sqlalchemy.TEXT)
+    run_metrics = sqlalchemy.Column(JSONB)
+
+    __table_args__ = (
+        # at most one pending job per metric, also when enqueued concurrently
+        sqlalchemy.Index('forecast_jobs_pending_uk', 'metric_name', unique=True,
+                         postgresql_where=sqlalchemy.text("state IN ('queued', 'running')")),
+        # claiming the oldest queued job does not scan finished jobs
+        sqlalchemy.Index('forecast_jobs_queued_idx', 'enqueued_ts',
+                         postgresql_where=sqlalchemy.text("state = 'queued'")),
+    )
+
+
+def enqueue_forecasts(metric_names: [str]) -> {str: int}:
+    """
+    Requests forecast runs of metrics, unless a run of the metric is already queued or running
+
+    Args:
+        metric_names: The names of forecasts in `config.forecasts()`
+
+    Returns:
+        The id of the pending job per metric name
+    """
+    from mara_prophet.forecast import ensure_mara_tables
+
+    ensure_mara_tables()
+    # a job of a lost worker would otherwise keep new jobs of its metric from being queued
+    fail_lost_jobs()
+    with connections.cursor_context('mara') as cursor:
+        cursor.execute(f'''
+        INSERT INTO forecast_jobs(metric_name, state, enqueued_ts)
+        SELECT metric_name, '{QUEUED}', {'%s'} FROM unnest({'%s'}::TEXT[]) metric_name
+        ON CONFLICT (metric_name) WHERE state IN ('{QUEUED}', '{RUNNING}') DO NOTHING''',
+                       (datetime.datetime.utcnow(), list(metric_names)))
+        cursor.execute(f'''
+        SELECT metric_name, id
+        FROM forecast_jobs
+        WHERE metric_name = ANY({'%s'}) AND state IN ('{QUEUED}', '{RUNNING}')''', (list(metric_names),))
+        return dict(cursor.fetchall())
+
+
+def job_status(job_id: int) -> dict:
+    """The state of a job, its timestamps and its error or run metrics, None when there is no such job"""
+    with connections.cursor_context('mara') as cursor:
+        cursor.execute(f'''
+        SELECT id, metric_name, state, enqueued_ts, started_ts, finished_ts, worker, heartbeat_ts, error,
+               run_metrics,
+               (SELECT count(*) FROM forecast_jobs queued
+                WHERE queued.state = '{QUEUED}' AND queued.enqueued_ts < forecast_jobs.enqueued_ts) AS queue_position
+        FROM forecast_jobs WHERE id = {'%s'}''', (job_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        return dict(zip([column.name for column in cursor.description], row))
+
+
+def claim_job(worker: str) -> (int, str):
+    """
+    Marks the oldest queued job as running, skipping jobs that are being claimed by other workers
+
+    Returns:
+        The id and the metric name of the claimed job, None when no job is queued
+    """
+    now = datetime.datetime.utcnow()
+    with connections.cursor_context('mara') as cursor:
+        cursor.execute(f'''
+        UPDATE forecast_jobs SET state = '{RUNNING}', started_ts = {'%s'}, heartbeat_ts = {'%s'}, worker = {'%s'}
+        WHERE id = (SELECT id FROM forecast_jobs
+                    WHERE state = '{QUEUED}'
+                    ORDER BY enqueued_ts, id
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED)
+        RETURNING id, metric_name''', (now, now, worker))
+        return cursor.fetchone()
+
+
+def renew_leases(job_ids: [int], worker: str):
+    """Records that the running jobs of a worker are still being processed"""
+    if not job_ids:
+        return
+    with connections.cursor_context('mara') as cursor:
+        cursor.execute(f'''
+        UPDATE forecast_jobs SET heartbeat_ts = {'%s'}
+        WHERE id = ANY({'%s'}) AND state = '{RUNNING}' AND worker = {'%s'}''',
+                       (datetime.datetime.utcnow(), list(job_ids), worker))
+
+
+def fail_lost_jobs() -> int:
+    """
+    Marks running jobs as failed when their worker has not renewed their lease for
+    `config.forecast_job_lease_seconds()`, e.g. because it has been killed
+
+    Returns:
+        The number of failed jobs
+    """
+    with connections.cursor_context('mara') as cursor:
+        cursor.execute(f'''
+        UPDATE forecast_jobs
+        SET state = '{FAILED}', finished_ts = {'%s'},
+            error = 'Lost worker ' || coalesce(worker, '') || ', no heartbeat since '
+                    || coalesce(heartbeat_ts, started_ts)
+        WHERE state = '{RUNNING}' AND coalesce(heartbeat_ts, started_ts) < {'%s'}''',
+                       (datetime.datetime.utcnow(),
+                        datetime.datetime.utcnow()
+                        - datetime.timedelta(seconds=mara_prophet.config.forecast_job_lease_seconds())))
+        if cursor.rowcount:
+            logging.warning(f'Failed {cursor.rowcount} forecast jobs of lost workers')
+        return cursor.rowcount
+
+
+def finish_job(job_id: int, run_metrics: dict = None, error: str = None):
+    """Marks a running job as succeeded, or as failed when an error is given"""
+    with connections.cursor_context('mara') as cursor:
+        cursor.execute(f'''
+        UPDATE forecast_jobs
+        SET state = {'%s'}, finished_ts = {'%s'}, error = {'%s'}, run_metrics = {'%s'}
+        WHERE state = '{RUNNING}' AND id = {'%s'}''', (FAILED if error else SUCCEEDED, datetime.datetime.utcnow(),
+                                                      error, json.dumps(run_metrics) if run_metrics else None,
+                                                      job_id))
+
+
+def _raise_on_sigterm(worker_pid: int):
+    """
+    Turns SIGTERM (as sent by systemd, kubernetes etc. on stop) into an exception in the worker process, so that its
+    running jobs are marked as failed. Forked forecast processes terminate as they would without the handler
+    """
+
+    def handler(signum, frame):
+        if os.getpid() != worker_pid:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            os.kill(os.getpid(), signal.SIGTERM)
+            return
+        raise SystemExit(f'Forecast worker terminated by signal {signum}')
+
+    return signal.signal(signal.SIGTERM, handler)
+
+
+def _run_job(metric_name: str) -> dict:
+    """Runs the forecast of a job in a worker process, returns the metrics of the run"""
+    from mara_prophet.forecast import forecasts_by_name
+
+    forecast = forecasts_by_name().get(metric_name)
+    if not forecast:
+        raise ValueError(f'There is no defined forecast with name "{metric_name}"')
+    return forecast.forecast_metric()
+
+
+def run_worker(concurrency: int = None, poll_interval: float = 5, max_jobs: int = None):
+    """
+    Claims queued forecast jobs and runs them in parallel worker processes until interrupted.
+    Any number of workers (also on different machines) can process the same queue.
+    The leases of running jobs are renewed at least every third of `config.forecast_job_lease_seconds()`
+
+    Args:
+        concurrency: The maximum number of forecasts running at the same time, defaults to the number of CPUs
+        poll_interval: The number of seconds to wait before looking for new jobs when the queue is empty
+        max_jobs: When given, the worker stops after having claimed this number of jobs
+    """
+    from mara_prophet.forecast import ensure_mara_tables
+
+    instrumentation.add_stdout_logging_handler(logging.getLogger())
+    ensure_mara_tables()
+
+    concurrency = concurrency or os.cpu_count()
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    logging.info(f'Forecast worker {worker} running up to {concurrency} jobs at the same time')
+    wait_interval = min(poll_interval, mara_prophet.config.forecast_job_lease_seconds() / 3)
+
+    previous_sigterm_handler = None
+    if threading.current_thread() is threading.main_thread():
+        previous_sigterm_handler = _raise_on_sigterm(os.getpid())
+
+    claimed = 0
+    running = {}  # future -> (job id, metric name)
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=concurrency)
+    try:
+        while True:
+            renew_leases([job_id for job_id, metric_name in running.values()], worker)
+            fail_lost_jobs()
+
+            # only claim jobs that can be started right away, so that idle workers can take the rest
+            while len(running) < concurrency and (max_jobs is None or claimed < max_jobs):
+                job = claim_job(worker)
+                if not job:
+                    break
+                claimed += 1
+                logging.info(f'Running job {job[0]}: forecast of "{job[1]}"')
+                running[executor.submit(_run_job, job[1])] = job
+
+            if not running:
+                if max_jobs is not None and claimed >= max_jobs:
+                    return
+                time.sleep(poll_interval)
+                continue
+
+            done, _ = concurrent.futures.wait(running, timeout=wait_interval,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                job_id, metric_name = running.pop(future)
+                try:
+                    finish_job(job_id, run_metrics=future.result())
+                    logging.info(f'Job {job_id} ("{metric_name}") succeeded')
+                except concurrent.futures.process.BrokenProcessPool as e:
+                    finish_job(job_id, error=f'The worker process terminated abruptly: {e!r}')
+                    logging.error(f'Job {job_id} ("{metric_name}") failed: worker process terminated')
+                except Exception as e:
+                    finish_job(job_id, error=repr(e))
+                    logging.error(f'Job {job_id} ("{metric_name}") failed: {e!r}')
+
+            if any(isinstance(future.exception(), concurrent.futures.process.BrokenProcessPool)
+                   for future in done):
+                # all other running jobs are lost with the broken pool as well
+                for job_id, metric_name in running.values():
+                    finish_job(job_id, error='The worker process pool broke')
+                running = {}
+                executor.shutdown(wait=False)
+                executor = concurrent.futures.ProcessPoolExecutor(max_workers=concurrency)
+    finally:
+        for job_id, metric_name in running.values():
+            finish_job(job_id, error=f'Worker {worker} stopped')
+        executor.shutdown(wait=False)
+        if previous_sigterm_handler is not None:
+            signal.signal(signal.SIGTERM, previous_sigterm_handler)
@@ -0,0 +1,130 @@
+"""Slim, pre-aligned time series for plotting forecasts"""
+
+import functools
+import typing
+
+if typing.TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+
+PLOT_SERIES_COLUMNS = ['ds', 'y', 'yhat', 'yhat_lower', 'yhat_upper']
+
+# the data frames of a forecast run are only read when it has no stored plot series
+_PLOT_SERIES_SOURCES = ('plot_series, '
+                        'CASE WHEN plot_series IS NULL THEN forecasts_df END, '
+                        'CASE WHEN plot_series IS NULL THEN source_df END')
+
+
+def build_plot_series(source_df: 'pd.DataFrame', forecast_df: 'pd.DataFrame') -> 'pd.DataFrame':
+    """
+    Aligns the actual values with the values predicted after the last actual date, without joins or index mutations
+
+    Returns:
+        A data frame ordered by `ds` with the columns ds, y (empty in the future),
+        yhat, yhat_lower and yhat_upper (empty in the past)
+    """
+    import numpy as np
+    import pandas as pd
+
+    source_ds = pd.to_datetime(source_df['ds']).values
+    forecast_ds = pd.to_datetime(forecast_df['ds']).values
+    future = forecast_ds > source_ds.max()
+    n_past, n_future = len(source_ds), int(future.sum())
+
+    plot_series = pd.DataFrame({
+        'ds': np.concatenate([source_ds, forecast_ds[future]]),
+        'y': np.concatenate([source_df['y'].values.astype(np.float64), np.full(n_future, np.nan)]),
+        **{column: np.concatenate([np.full(n_past, np.nan), forecast_df[column].values[future].astype(np.float64)])
+           for column in ['yhat', 'yhat_lower', 'yhat_upper']}})
+
+    if not plot_series['ds'].is_monotonic_increasing:
+        plot_series = plot_series.sort_values('ds', kind='mergesort').reset_index(drop=True)
+    return plot_series
+
+
+@functools.lru_cache(maxsize=64)
+def get_plot_series(name: str, forecast_ts, modified_ts) -> 'pd.DataFrame':
+    """
+    The plot series of a forecast run, built from its data frames for runs that have not stored one.
+    Cached per (metric_name, forecast_ts, modified_ts), must not be modified in place
+    """
+    from mara_prophet import connections
+
+    with connections.cursor_context('mara') as cursor:
+        cursor.execute(f'''
+        SELECT {_PLOT_SERIES_SOURCES}
+        FROM forecasts WHERE metric_name = {'%s'} AND forecast_ts = {'%s'}''', (name, forecast_ts))
+        return _decode_plot_series(*cursor.fetchone())
+
+
+def read_plot_series(forecast_ids: [int]) -> {int: 'pd.DataFrame'}:
+    """The plot series of multiple forecast runs by id, read with a single query"""
+    from mara_prophet import connections
+
+    if not forecast_ids:
+        return {}
+    with connections.cursor_context('mara') as cursor:
+        cursor.execute(f'''
+        SELECT id, {_PLOT_SERIES_SOURCES}
+        FROM forecasts WHERE id = ANY({'%s'})''', (list(forecast_ids),))
+        return {forecast_id: _decode_plot_series(*sources) for forecast_id, *sources in cursor.fetchall()}
+
+
+def _decode_plot_series(plot_series: bytes, forecasts_df: bytes, source_df: bytes) -> 'pd.DataFrame':
+    from mara_prophet import serialization
+
+    if plot_series is not None:
+        return serialization.decode_dataframe(plot_series)
+    return build_plot_series(serialization.decode_dataframe(source_df), serialization.decode_dataframe(forecasts_df))
+
+
+def lttb_indices(x: 'np.ndarray', y: 'np.ndarray', threshold: int) -> 'np.ndarray':
+    """
+    Selects `threshold` points that preserve the visual shape of a series with the
+    Largest-Triangle-Three-Buckets algorithm (Steinarsson 2013)
+
+    Args:
+        x: Ascending x values as floats
+        y: The y values, without NaNs
+        threshold: The number of points to keep
+
+    Returns:
+        The ascending indices of the selected points
+    """
+    import numpy as np
+
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    # the first and the last point are always kept, all others are split into threshold - 2 buckets
+    bucket_edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    indices = np.empty(threshold, dtype=int)
+    indices[0], indices[-1] = 0, n - 1
+
+    selected = 0
+    for bucket in range(threshold - 2):
+        start, end = bucket_edges[bucket], bucket_edges[bucket + 1]
+        next_end = bucket_edges[bucket + 2] if bucket + 2 < len(bucket_edges) else n
+        average_x, average_y = x[end:next_end].mean(), y[end:next_end].mean()
+
+        # the point forming the largest triangle with the previously selected point and the next bucket's average
+        areas = np.abs((x[selected] - average_x) * (y[start:end] - y[selected])
+                       - (x[selected] - x[start:end]) * (average_y - y[selected]))
+        selected = start + int(np.argmax(areas))
+        indices[bucket + 1] = selected
+
+    return indices
+
+
+def downsample_plot_series(plot_series: 'pd.DataFrame', max_points: int) -> 'pd.DataFrame':
+    """Reduces a plot series to at most `max_points` rows, keeping its visual shape"""
+    import numpy as np
+
+    if not max_points or len(plot_series) <= max_points:
+        return plot_series
+
+    x = plot_series['ds'].values.astype('datetime64[ns]').astype(np.int64).astype(np.float64)
+    y = plot_series['y'].fillna(plot_series['yhat']).values
+    y = np.where(np.isnan(y), np.nanmean(y) if not np.isnan(y).all() else 0, y)
+    return plot_series.iloc[lttb_indices(x, y, max_points)].reset_index(drop=True)
@@ -0,0 +1,70 @@
+"""Thinning of historized forecasts that are older than the latest runs of a metric"""
+
+import logging
+
+import mara_prophet.config
+from mara_prophet import connections, serialization
+from psycopg2 import Binary
+
+
+def compact_forecasts(keep_runs: int = None, batch_size: int = 50) -> int:
+    """
+    Keeps the latest runs of each metric at full fidelity and thins all older runs in `forecasts`:
+    figures, source data, plot series and model parameters are dropped and only the predicted values after the
+    last actual date are kept (as needed for tracking the accuracy of past forecasts against later actuals)
+
+    Args:
+        keep_runs: The number of latest runs per metric that are not thinned, defaults to
+                   `config.forecast_retention_runs()`
+        batch_size: The number of rows that are thinned per transaction
+
+    Returns:
+        The number of thinned forecast runs
+    """
+    import pandas as pd
+
+    keep_runs = mara_prophet.config.forecast_retention_runs() if keep_runs is None else keep_runs
+    if keep_runs is None:
+        logging.info('No forecast retention configured, nothing to compact')
+        return 0
+
+    with connections.cursor_context('mara') as cursor:
+        cursor.execute(f'''
+        SELECT id
+        FROM (SELECT id, 
+                     row_number() OVER (PARTITION BY metric_name ORDER BY forecast_ts DESC) AS run,
+                     source_df IS NOT NULL OR plot_series IS NOT NULL OR components_figure IS NOT NULL
+                       OR main_figure IS NOT NULL OR model_parameters IS NOT NULL AS full_fidelity
+              FROM forecasts) runs
+        WHERE run > {'%s'} AND full_fidelity
+          AND id NOT IN (SELECT forecast_id FROM latest_forecasts)
+        ORDER BY id''', (max(keep_runs, 1),))
+        ids = [row[0] for row in cursor.fetchall()]
+
+    logging.info(f'Compacting {len(ids)} forecast runs')
+    compacted = 0
+    for offset in range(0, len(ids), batch_size):
+        with connections.cursor_context('mara') as cursor:
+            cursor.execute('SELECT id, forecasts_df, source_df, plot_series FROM forecasts '
+                           'WHERE id = ANY(%s) FOR UPDATE', (ids[offset:offset + batch_size],))
+            for forecast_id, forecasts_df, source_df, plot_series in cursor.fetchall():
+                if forecasts_df is not None:
+                    actuals_df = source_df if source_df is not None else plot_series
+                    try:
+                        # pickles are only decoded when allowed by `config.allow_pickle_deserialization()`
+                        forecasts_df = serialization.decode_dataframe(forecasts_df)
+                        actuals_df = serialization.decode_dataframe(actuals_df)
+                    except ValueError as e:
+                        logging.warning(f'Skipping forecast id={forecast_id}, its data can not be decoded: {e}')
+                        continue
+                    if actuals_df is not None:
+                        last_actual_date = pd.to_datetime(actuals_df.loc[actuals_df['y'].notnull(), 'ds']).max()
+                        forecasts_df = forecasts_df[pd.to_datetime(forecasts_df['ds']) > last_actual_date]
+                    forecasts_df = Binary(serialization.encode_dataframe(forecasts_df,
+                                                                         serialization.FORECASTS_DF_COLUMNS))
+
+                cursor.execute('UPDATE forecasts SET forecasts_df = %s, source_df = NULL, plot_series = NULL, '
+                               'components_figure = NULL, main_figure = NULL, model_parameters = NULL '
+                               'WHERE id = %s', (forecasts_df, forecast_id))
+                compacted += 1
+    return compacted
@@ -0,0 +1,171 @@
+"""Encoding of the data frames and figures that are stored in the 'mara' database"""
+
+import abc
+import base64
+import io
+import logging
+import pickle
+
+import mara_prophet.config
+from mara_prophet import connections
+from psycopg2 import Binary
+
+# The columns of the forecasts data frame that are used by the views and the validation
+FORECASTS_DF_COLUMNS = ['ds', 'yhat', 'yhat_lower', 'yhat_upper']
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+class DataFrameCodec(abc.ABC):
+    """Encodes pandas data frames into bytes and back"""
+
+    @abc.abstractmethod
+    def encode(self, df) -> bytes:
+        pass
+
+    @abc.abstractmethod
+    def decode(self, data: bytes):
+        pass
+
+    @abc.abstractmethod
+    def can_decode(self, data: bytes) -> bool:
+        """Whether `data` has been encoded by this codec"""
+        pass
+
+
+class ParquetCodec(DataFrameCodec):
+    """Apache Parquet files, column-wise compressed"""
+
+    def __init__(self, compression: str = 'zstd'):
+        self.compression = compression
+
+    def encode(self, df) -> bytes:
+        output = io.BytesIO()
+        df.to_parquet(output, engine='pyarrow', compression=self.compression, index=False)
+        return output.getvalue()
+
+    def decode(self, data: bytes):
+        import pandas as pd
+        return pd.read_parquet(io.BytesIO(data), engine='pyarrow')
+
+    def can_decode(self, data: bytes) -> bool:
+        return data[:4] == b'PAR1'
+
+
+class ArrowCodec(DataFrameCodec):
+    """Apache Arrow IPC (Feather V2) files, fast to decode at slightly larger sizes than Parquet"""
+
+    def __init__(self, compression: str = 'lz4'):
+        self.compression = compression
+
+    def encode(self, df) -> bytes:
+        output = io.BytesIO()
+        df.reset_index(drop=True).to_feather(output, compression=self.compression)
+        return output.getvalue()
+
+    def decode(self, data: bytes):
+        import pandas as pd
+        return pd.read_feather(io.BytesIO(data))
+
+    def can_decode(self, data: bytes) -> bool:
+        return data[:6] == b'ARROW1'
+
+
+class PickleCodec(DataFrameCodec):
+    """Python pickles, as written by mara-prophet up to version 2.0.2"""
+
+    def __init__(self, allow_unpickling: bool = None):
+        self.allow_unpickling = allow_unpickling
+
+    def encode(self, df) -> bytes:
+        return pickle.dumps(df)
+
+    def decode(self, data: bytes):
+        if not (mara_prophet.config.allow_pickle_deserialization()
+                if self.allow_unpickling is None else self.allow_unpickling):
+            raise ValueError('Refusing to unpickle data from the database, please re-encode stored forecasts '
+                             'with `mara_prophet.serialization.migrate_stored_data()`')
+        return pickle.loads(data)
+
+    def can_decode(self, data: bytes) -> bool:
+        return data[:1] == b'\x80'
+
+
+def encode_dataframe(df, columns: [str] = None) -> bytes:
+    """
+    Encodes a data frame with the configured codec
+
+    Args:
+        df: The data frame to encode
+        columns: When given, only these columns (as far as existing) are kept
+    """
+    if columns:
+        df = df[[column for column in columns if column in df.columns]]
+    return mara_prophet.config.dataframe_codec().encode(df)
+
+
+def decode_dataframe(data: bytes, allow_unpickling: bool = None):
+    """Decodes a data frame that has been encoded by any of the known codecs"""
+    if data is None:
+        return None
+    data = bytes(data)
+    for codec in [mara_prophet.config.dataframe_codec(), ParquetCodec(), ArrowCodec(),
+                  PickleCodec(allow_unpickling)]:
+        if codec.can_decode(data):
+            return codec.decode(data)
+    raise ValueError('Unknown data frame encoding')
+
+
+def encode_figure(png_base64: str) -> bytes:
+    """Encodes a base64 encoded PNG figure as raw PNG bytes"""
+    return base64.b64decode(png_base64)
+
+
+def decode_figure(data: bytes, allow_unpickling: bool = None) -> str:
+    """Decodes a stored figure into a base64 encoded PNG"""
+    if data is None:
+        return None
+    data = bytes(data)
+    if data[:8] == PNG_SIGNATURE:
+        return base64.b64encode(data).decode('utf-8')
+    return PickleCodec(allow_unpickling).decode(data)
+
+
+def migrate_stored_data(batch_size: int = 50):
+    """
+    Re-encodes all data frames and figures of the `forecasts` and `forecasts_cross_validation` tables
+    with the configured codec, e.g. pickles written by previous versions of mara-prophet
+
+    Args:
+        batch_size: The number of rows that are re-encoded per transaction
+    """
+    for table_name, columns in [
+        ('forecasts', {'forecasts_df': FORECASTS_DF_COLUMNS, 'source_df': None, 'plot_series': None,
+                       'components_figure': 'figure', 'main_figure': 'figure'}),
+        ('forecasts_cross_validation', {'cross_validation_df': None, 'metrics_df': None})]:
+
+        with connections.cursor_context('mara') as cursor:
+            cursor.execute(f'SELECT id FROM {table_name} ORDER BY id')
+            ids = [row[0] for row in cursor.fetchall()]
+
+        logging.info(f'Re-encoding {len(ids)} rows of "{table_name}"')
+        for offset in range(0, len(ids), batch_size):
+            with connections.cursor_context('mara') as cursor:
+                cursor.execute(f'SELECT id, {", ".join(columns)} FROM {table_name} WHERE id = ANY(%s) FOR UPDATE',
+                               (ids[offset:offset + batch_size],))
+                for row in cursor.fetchall():
+                    values = []
+                    for (column, kept_columns), data in zip(columns.items(), row[1:]):
+                        if data is None:
+                            values.append(None)
+                        elif kept_columns == 'figure':
+                            values.append(Binary(encode_figure(decode_figure(data, allow_unpickling=True))))
+                        else:
+                            # only pickles of previous versions hold all columns of a Prophet forecast,
+                            # the columns of other encodings have already been chosen by the output profile
+                            values.append(Binary(encode_dataframe(
+                                decode_dataframe(data, allow_unpickling=True),
+                                kept_columns if PickleCodec().can_decode(bytes(data)) else None)))
+
+                    cursor.execute(f'UPDATE {table_name} SET {", ".join(f"{column} = %s" for column in columns)} '
+                                   f'WHERE id = %s', values + [row[0]])
@@ -1,16 +1,51 @@
 """Helper methods to generate PostgreSQL queries for Mara Prophet"""
 
+# The `date_trunc` field per forecast frequency
+DATE_TRUNC_FIELDS = {'hourly': 'hour', 'daily': 'day', 'weekly': 'week'}
+
+
+def ds_expression(ds_column: str, frequency: str = None) -> str:
+    """The date column, truncated to the periods of a frequency when given (for aggregating e.g. hourly to daily)"""
+    if frequency is None:
+        return ds_column
+    assert frequency in DATE_TRUNC_FIELDS, f'Unknown frequency "{frequency}"'
+    return f"date_trunc('{DATE_TRUNC_FIELDS[frequency]}', ({ds_column})::TIMESTAMP)"
+
 
 def build_time_series_sql_query(schema_name: str, table_name: str, ds_column: str, y_expression: str,
-                                where_condition: str = None):
+                                where_condition: str = None, frequency: str = None):
+    """
+    A query returning (ds, y) rows for forecasting a metric
+
+    Args:
+        frequency: When given, rows are aggregated per 'hourly', 'daily' or 'weekly' period of `ds_column`
+                   with the (aggregate) `y_expression`
+    """
     return f"""
 SELECT * FROM (
-    SELECT {ds_column} AS ds,
+    SELECT {ds_expression(ds_column, frequency)} AS ds,
     {y_expression} AS y
     FROM {schema_name}.{table_name} 
     WHERE {where_condition if where_condition is not None else '1=1'}
     GROUP BY 1
-    ORDER BY 1 DESC
+    ORDER BY 1
+) AS t
+WHERE y != 0
+"""
+
+
+def build_grouped_time_series_sql_query(schema_name: str, table_name: str, ds_column: str, group_expression: str,
+                                        y_expression: str, where_condition: str = None, frequency: str = None):
+    """A single query returning (ds, group_key, y) rows for forecasting a metric per group, e.g. per country"""
+    return f"""
+SELECT * FROM (
+    SELECT {ds_expression(ds_column, frequency)} AS ds,
+    {group_expression} AS group_key,
+    {y_expression} AS y
+    FROM {schema_name}.{table_name} 
+    WHERE {where_condition if where_condition is not None else '1=1'}
+    GROUP BY 1, 2
+    ORDER BY 2, 1
 ) AS t
 WHERE y != 0
 """
@@ -11,3 +11,98 @@ function downloadCSV(query_id, metric_name, chart_title) {
     $('#download-csv-dialog input[name=chart_title]').val(chart_title);
     $('#download-csv-dialog').modal();
 }
+
+/** queues a refresh of a forecast and shows the state of the job until it has finished */
+function refreshForecast(url, statusElementId) {
+    var status = $('#' + statusElementId);
+    $.post(url)
+        .done(function (job) {
+            function poll() {
+                $.getJSON(job.status_url).done(function (job) {
+                    if (job.state == 'queued') {
+                        status.text('queued (position ' + (job.queue_position + 1) + ') ');
+                    } else {
+                        status.text(job.state + ' ');
+                    }
+                    if (job.state == 'queued' || job.state == 'running') {
+                        setTimeout(poll, 5000);
+                    } else if (job.state == 'failed') {
+                        status.attr('title', job.error);
+                    }
+                });
+            }
+            poll();
+        })
+        .fail(function (response) {
+            status.text('could not queue refresh ');
+        });
+}
+
+/** loads plots and charts only when they are scrolled into view */
+$(function () {
+    var lazyElements = $('div.lazy-content, div.forecast-chart');
+    if ($('div.forecast-chart').length) {
+        google.charts.load('current', {packages: ['corechart']});
+    }
+
+    function load(element) {
+        if ($(element).hasClass('forecast-chart')) {
+            google.charts.setOnLoadCallback(function () {
+                drawForecastChart(element);
+            });
+        } else {
+            loadContentAsynchronously(element.id, $(element).data('url'));
+        }
+    }
+
+    if (!('IntersectionObserver' in window)) {
+        lazyElements.each(function () {
+            load(this);
+        });
+        return;
+    }
+
+    var observer = new IntersectionObserver(function (entries) {
+        entries.forEach(function (entry) {
+            if (entry.isIntersecting) {
+                observer.unobserve(entry.target);
+                load(entry.target);
+            }
+        });
+    }, {rootMargin: '200px'});
+    lazyElements.each(function () {
+        observer.observe(this);
+    });
+});
+
+/** draws the actual and predicted values of a forecast from the json data endpoint */
+function drawForecastChart(container) {
+    $.getJSON($(container).data('url'))
+        .done(function (series) {
+            var data = new google.visualization.DataTable();
+            data.addColumn('date', 'Date');
+            data.addColumn('number', 'Actual metric');
+            data.addColumn('number', 'Predicted metric');
+            data.addColumn({type: 'number', role: 'interval'});
+            data.addColumn({type: 'number', role: 'interval'});
+
+            var rows = new Array(series.ds.length);
+            for (var i = 0; i < series.ds.length; i++) {
+                rows[i] = [new Date(series.ds[i]), series.y[i], series.yhat[i], series.yhat_lower[i], series.yhat_upper[i]];
+            }
+            data.addRows(rows);
+
+            new google.visualization.LineChart(container).draw(data, {
+                height: 400,
+                chartArea: {left: 80, right: 20, top: 20, bottom: 60},
+                legend: {position: 'bottom'},
+                intervals: {style: 'area', color: 'darkgray'},
+                series: {1: {color: 'black', lineDashStyle: [2, 2]}},
+                hAxis: {title: 'Date'},
+                vAxis: {title: $(container).data('label')}
+            });
+        })
+        .fail(function () {
+            $(container).text('No data yet.');
+        });
+}
@@ -0,0 +1,237 @@
+"""Hyper parameter tuning of forecasts by cross validating a grid of seasonality and changepoint settings"""
+
+import copy
+import datetime
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import time
+import typing
+
+from mara_prophet import connections, instrumentation
+import sqlalchemy
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.declarative import declarative_base
+
+if typing.TYPE_CHECKING:
+    import pandas as pd
+    from mara_prophet.forecast import Forecast, Seasonality, Changepoint
+
+Base = declarative_base()
+
+
+class ForecastTuningBase(Base):
+    """
+    Stores the outcome of tuning the hyper parameters of a metric: the winning candidate and the scores of all
+    evaluated candidates. The latest winner of a metric is used by forecasts with `use_tuned_parameters=True`
+    """
+    __tablename__ = 'forecasts_tuning'
+
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    metric_name = sqlalchemy.Column(sqlalchemy.TEXT, nullable=False)
+    tuning_ts = sqlalchemy.Column(sqlalchemy.DateTime(timezone=True), nullable=False)
+    horizon_days = sqlalchemy.Column(sqlalchemy.Integer)
+    score_metric = sqlalchemy.Column(sqlalchemy.TEXT)
+    score = sqlalchemy.Column(sqlalchemy.Float)
+    tuned_parameters = sqlalchemy.Column(JSONB)
+    candidates = sqlalchemy.Column(JSONB)
+
+    __table_args__ = (sqlalchemy.Index('forecasts_tuning_metric_name_tuning_ts_idx', 'metric_name', 'tuning_ts'),)
+
+
+SEASONALITY_PARAMETERS = ['seasonality_mode', 'seasonality_prior_scale', 'yearly_seasonality',
+                          'weekly_seasonality', 'daily_seasonality']
+CHANGEPOINT_PARAMETERS = ['changepoints', 'n_changepoints', 'changepoint_range', 'changepoint_prior_scale']
+
+
+def apply_parameters(seasonality: 'Seasonality', changepoint: 'Changepoint',
+                     parameters: dict) -> ('Seasonality', 'Changepoint'):
+    """New seasonality and changepoint settings with some of their fields overridden by `parameters`"""
+    from mara_prophet.forecast import Seasonality, Changepoint
+
+    unknown_parameters = set(parameters) - set(SEASONALITY_PARAMETERS) - set(CHANGEPOINT_PARAMETERS)
+    assert not unknown_parameters, f'Unknown parameters: {", ".join(sorted(unknown_parameters))}'
+
+    return (Seasonality(**{**vars(seasonality),
+                           **{name: value for name, value in parameters.items() if name in SEASONALITY_PARAMETERS}}),
+            Changepoint(**{**vars(changepoint),
+                           **{name: value for name, value in parameters.items() if name in CHANGEPOINT_PARAMETERS}}))
+
+
+def tuned_settings(metric_name: str, seasonality: 'Seasonality',
+                   changepoint: 'Changepoint') -> ('Seasonality', 'Changepoint'):
+    """
+    The seasonality and changepoint settings of a metric with the parameters of its latest tuning winner applied,
+    unchanged when the metric has not been tuned
+
+    Args:
+        metric_name: The normalized metric name
+    """
+    with connections.cursor_context('mara') as cursor:
+        cursor.execute(f'''
+        SELECT tuned_parameters
+        FROM forecasts_tuning WHERE metric_name = {'%s'}
+        ORDER BY tuning_ts DESC
+        LIMIT 1''', (metric_name,))
+        result = cursor.fetchone()
+
+    if not result:
+        return seasonality, changepoint
+    logging.info(f'Using tuned parameters of "{metric_name}": {json.dumps(result[0])}')
+    return apply_parameters(seasonality, changepoint, result[0])
+
+
+# The forecast and its log transformed source data in tuning worker processes,
+# set once per process by the pool initializer instead of being sent with every task
+_worker_forecast = None
+_worker_df = None
+
+
+def _initialize_worker(forecast: 'Forecast', df: 'pd.DataFrame'):
+    global _worker_forecast, _worker_df
+    _worker_forecast, _worker_df = forecast, df
+
+
+def _evaluate_candidate(candidate: int, parameters: dict, cutoff: 'pd.Timestamp',
+                        horizon: 'pd.Timedelta') -> (int, 'pd.Timestamp', dict):
+    """
+    Fits a candidate on the history up to `cutoff` and sums up its errors over the following `horizon`
+
+    Returns:
+        The candidate, the cutoff and the sums of squared and absolute percentage errors with their count,
+        None when the fit failed
+    """
+    import numpy as np
+    from mara_prophet.validation import changepoints_before, fit_and_predict_cutoff
+
+    forecast, df = _worker_forecast, _worker_df
+
+    try:
+        candidate_forecast = copy.copy(forecast)
+        candidate_forecast.seasonality, candidate_forecast.changepoint = apply_parameters(
+            forecast.seasonality, forecast.changepoint, parameters)
+        if candidate_forecast.changepoint.changepoints is not None:
+            candidate_forecast.changepoint.changepoints = changepoints_before(
+                candidate_forecast.changepoint.changepoints, cutoff)
+
+        # errors at original scale
+        result = fit_and_predict_cutoff(candidate_forecast.build_model(uncertainty_samples=0), df, cutoff, horizon)
+        y, yhat = result['y'].values, result['yhat'].values
+    except Exception as e:
+        logging.warning(f'Candidate {json.dumps(parameters, default=str)} failed at cutoff {cutoff:%Y-%m-%d}: {e!r}')
+        return candidate, cutoff, None
+
+    return candidate, cutoff, {'squared_errors': float(np.sum((y - yhat) ** 2)),
+                               'absolute_percentage_errors': float(np.sum(np.abs((y - yhat) / y))),
+                               'count': len(y)}
+
+
+def tune_forecast(metric_name: str, parameter_grid: {str: list}, horizon_days: int, initial_days: int = None,
+                  period_days: int = None, score_metric: str = 'rmse', reduction_factor: int = 3,
+                  workers: int = None, timeout: int = None) -> dict:
+    """
+    Searches a grid of seasonality and changepoint parameters of a configured forecast for the candidate with the
+    lowest cross validation error and records it as the winner of the metric in `forecasts_tuning`.
+
+    Candidates are pruned by successive halving: all candidates are first evaluated on the latest few cutoffs only,
+    and with every round just the best `1 / reduction_factor` of them are evaluated on more cutoffs.
+
+    Args:
+        metric_name: The name of a forecast in `config.forecasts()`
+        parameter_grid: The values to try per field of `Seasonality` and `Changepoint`, e.g.
+                        `{'changepoint_prior_scale': [0.01, 0.1, 0.5], 'seasonality_mode': ['additive', 'multiplicative']}`
+        horizon_days: The number of days to forecast after each cutoff
+        initial_days: The minimum number of days of history before the first cutoff, defaults to 3 horizons
+        period_days: The number of days between cutoffs, defaults to half a horizon
+        score_metric: 'rmse' or 'mape'
+        reduction_factor: The factor by which the number of candidates is reduced per round
+        workers: The number of worker processes fitting candidates, defaults to the number of CPUs
+        timeout: The number of seconds after which no further rounds are started
+
+    Returns:
+        The winning parameters and their score, None when no candidate could be evaluated
+    """
+    import numpy as np
+    import pandas as pd
+
+    from mara_prophet.forecast import BreakdownForecast, ensure_mara_tables, forecasts_by_name, normalized_metric_name
+    from mara_prophet.validation import generate_validation_cutoffs
+
+    instrumentation.add_stdout_logging_handler(logging.getLogger())
+    assert score_metric in ['rmse', 'mape'], f'Unknown score metric "{score_metric}"'
+
+    forecast = forecasts_by_name().get(metric_name)
+    assert forecast, f'There is no defined forecast with name "{metric_name}"'
+    assert not isinstance(forecast, BreakdownForecast), 'Breakdown forecasts can not be tuned as a whole'
+    ensure_mara_tables()
+
+    candidates = [dict(zip(parameter_grid.keys(), values)) for values in itertools.product(*parameter_grid.values())]
+    apply_parameters(forecast.seasonality, forecast.changepoint, candidates[0])  # fail early on unknown parameters
+
+    df = forecast.read_data()
+    df['y'] = np.log(df['y'])
+
+    horizon = pd.Timedelta(days=horizon_days)
+    # the latest cutoffs are evaluated first
+    cutoffs = sorted(generate_validation_cutoffs(df, horizon, initial_days, period_days), reverse=True)
+
+    rounds = max(math.floor(math.log(len(candidates), reduction_factor)), 0) if reduction_factor > 1 else 0
+    number_of_cutoffs = max(len(cutoffs) // reduction_factor ** rounds, 1)
+
+    errors = {candidate: {} for candidate in range(len(candidates))}  # candidate -> cutoff -> error sums
+
+    def score(candidate: int) -> float:
+        if not errors[candidate] or None in errors[candidate].values():
+            return math.inf
+        count = sum(error['count'] for error in errors[candidate].values())
+        if score_metric == 'rmse':
+            return math.sqrt(sum(error['squared_errors'] for error in errors[candidate].values()) / count)
+        return sum(error['absolute_percentage_errors'] for error in errors[candidate].values()) / count
+
+    logging.info(f'Tuning "{metric_name}" with {len(candidates)} candidates and up to {len(cutoffs)} cutoffs')
+    deadline = time.monotonic() + timeout if timeout else None
+    remaining = list(range(len(candidates)))
+
+    # the source data is sent to each worker process once instead of with every fit
+    with multiprocessing.Pool(workers, initializer=_initialize_worker, initargs=(forecast, df)) as pool:
+        while True:
+            tasks = [(candidate, candidates[candidate], cutoff, horizon)
+                     for candidate in remaining for cutoff in cutoffs[:number_of_cutoffs]
+                     if cutoff not in errors[candidate]]
+            for candidate, cutoff, error in pool.starmap(_evaluate_candidate, tasks):
+                errors[candidate][cutoff] = error
+
+            remaining = sorted(remaining, key=score)
+            logging.info(f'Evaluated {len(remaining)} candidates on {number_of_cutoffs} cutoffs, best '
+                         f'{score_metric}: {score(remaining[0]):.4f} ({json.dumps(candidates[remaining[0]], default=str)})')
+
+            if number_of_cutoffs >= len(cutoffs) or len(remaining) == 1:
+                break
+            if deadline and time.monotonic() > deadline:
+                logging.error(f'Tuning timed out after {timeout} seconds, using the best candidate so far')
+                break
+            remaining = remaining[:max(len(remaining) // reduction_factor, 1)]
+            number_of_cutoffs = min(number_of_cutoffs * reduction_factor, len(cutoffs))
+
+    winner = remaining[0]
+    if math.isinf(score(winner)):
+        logging.error(f'None of the candidates of "{metric_name}" could be evaluated')
+        return None
+
+    with connections.cursor_context('mara') as cursor:
+        cursor.execute(
+            f"INSERT INTO forecasts_tuning(metric_name, tuning_ts, horizon_days, score_metric, score, "
+            f"tuned_parameters, candidates) "
+            f"VALUES ({'%s, %s, %s, %s, %s, %s, %s'})",
+            (normalized_metric_name(metric_name), datetime.datetime.utcnow(), horizon_days, score_metric, score(winner),
+             json.dumps(candidates[winner], default=str),
+             json.dumps([{'parameters': parameters,
+                          'cutoffs': len(errors[candidate]),
+                          'score': score(candidate) if not math.isinf(score(candidate)) else None}
+                         for candidate, parameters in enumerate(candidates)], default=str)))
+
+    logging.info(f'Winner of "{metric_name}": {json.dumps(candidates[winner], default=str)} '
+                 f'({score_metric} {score(winner):.4f})')
+    return {'parameters': candidates[winner], 'score': score(winner)}
@@ -1,20 +1,27 @@
 import logging
-import sys
+import multiprocessing
+import time
+import typing
 
-from fbprophet.diagnostics import cross_validation, performance_metrics
-import numpy as np
-import mara_db.postgresql
+import mara_prophet.config
+from mara_prophet import connections, instrumentation, serialization
 from psycopg2 import Binary
-import pickle
+from psycopg2.extras import execute_values
 import sqlalchemy
 from sqlalchemy.ext.declarative import declarative_base
 
+if typing.TYPE_CHECKING:
+    import pandas as pd
+    from fbprophet import Prophet
+
 Base = declarative_base()
 
 
 class ForecastCrossValidationBase(Base):
     """
-    Stores cross validation results from a given forecast
+    Stores cross validation results from a given forecast:
+    one row with the predictions per cutoff and one row (without cutoff) per completed cross validation,
+    which its performance metrics in `forecasts_cross_validation_metrics` refer to
     """
     __tablename__ = 'forecasts_cross_validation'
 
@@ -23,55 +30,338 @@ class ForecastCrossValidationBase(Base):
     horizon_days = sqlalchemy.Column(sqlalchemy.Integer)
     initial_days = sqlalchemy.Column(sqlalchemy.Integer)
     period_days = sqlalchemy.Column(sqlalchemy.Integer)
+    cutoff = sqlalchemy.Column(sqlalchemy.DateTime)
     cross_validation_df = sqlalchemy.Column(sqlalchemy.LargeBinary)
     metrics_df = sqlalchemy.Column(sqlalchemy.LargeBinary)
 
 
+class ForecastCrossValidationMetricBase(Base):
+    """
+    Stores the performance metrics of cross validations as plain rows per forecast horizon
+    """
+    __tablename__ = 'forecasts_cross_validation_metrics'
+
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    cross_validation_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('forecasts_cross_validation.id'),
+                                            nullable=False, index=True)
+    forecast_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('forecasts.id'), nullable=False)
+    metric_name = sqlalchemy.Column(sqlalchemy.TEXT, nullable=False, index=True)
+    horizon = sqlalchemy.Column(sqlalchemy.Interval, nullable=False)
+    mse = sqlalchemy.Column(sqlalchemy.Float)
+    rmse = sqlalchemy.Column(sqlalchemy.Float)
+    mae = sqlalchemy.Column(sqlalchemy.Float)
+    mape = sqlalchemy.Column(sqlalchemy.Float)
+    coverage = sqlalchemy.Column(sqlalchemy.Float)
+
+
 def insert_cross_validation_results_into_table(forecast_id: int, horizon_days: int, initial_days: int, period_days: int,
-                                               cross_validation_df, metrics_df):
-    with mara_db.postgresql.postgres_cursor_context('mara') as cursor:
+                                               cross_validation_df, metrics_df, cutoff=None) -> int:
+    with connections.cursor_context('mara') as cursor:
         cursor.execute(
             f"INSERT INTO forecasts_cross_validation"
-            f"(forecast_id, horizon_days, initial_days, period_days, cross_validation_df, metrics_df) "
-            f"VALUES ({'%s, %s, %s, %s, %s, %s'})",
-            (forecast_id, horizon_days, initial_days, period_days, Binary(cross_validation_df), Binary(metrics_df)))
+            f"(forecast_id, horizon_days, initial_days, period_days, cutoff, cross_validation_df, metrics_df) "
+            f"VALUES ({'%s, %s, %s, %s, %s, %s, %s'}) RETURNING id",
+            (forecast_id, horizon_days, initial_days, period_days, cutoff,
+             Binary(cross_validation_df) if cross_validation_df is not None else None,
+             Binary(metrics_df) if metrics_df is not None else None))
+        return cursor.fetchone()[0]
+
+
+def insert_performance_metrics_into_table(forecast_id: int, metric_name: str, horizon_days: int, initial_days: int,
+                                          period_days: int, metrics_df: 'pd.DataFrame'):
+    """Inserts the performance metrics of a cross validation as one row per horizon"""
+    import pandas as pd
+
+    cross_validation_id = insert_cross_validation_results_into_table(forecast_id, horizon_days, initial_days,
+                                                                     period_days, None, None)
+    columns = ['mse', 'rmse', 'mae', 'mape', 'coverage']
+    rows = [(cross_validation_id, forecast_id, metric_name, horizon.to_pytimedelta(),
+             *[float(row[column]) if column in row and pd.notnull(row[column]) else None for column in columns])
+            for horizon, row in zip(metrics_df['horizon'], metrics_df.to_dict('records'))]
+
+    with connections.cursor_context('mara') as cursor:
+        execute_values(cursor,
+                       f"INSERT INTO forecasts_cross_validation_metrics"
+                       f"(cross_validation_id, forecast_id, metric_name, horizon, {', '.join(columns)}) VALUES %s",
+                       rows)
+
+
+def build_model(hyper_parameters: dict, cutoff: 'pd.Timestamp' = None, uncertainty_samples: int = 1000) -> 'Prophet':
+    """
+    Creates an unfitted Prophet model from the hyper parameters that have been stored with a forecast
+
+    Args:
+        hyper_parameters: The `hyper_parameters` of a row in the `forecasts` table
+        cutoff: When given, specified changepoints after the cutoff are dropped
+        uncertainty_samples: The number of samples for estimating the uncertainty intervals
+    """
+    import pandas as pd
+    from fbprophet import Prophet
+
+    changepoints = None
+    if hyper_parameters.get('specified_changepoints'):
+        changepoints = changepoints_before(hyper_parameters['changepoints'] or [], cutoff)
+
+    holidays = None
+    if hyper_parameters.get('holiday_events'):
+        holidays = pd.DataFrame(hyper_parameters['holiday_events'])
+        holidays['ds'] = pd.to_datetime(holidays['ds'])
+    elif hyper_parameters['holidays']:
+        # forecasts stored before the complete holidays frame was kept only have the dates
+        holidays = pd.DataFrame({'holiday': 'holiday', 'ds': pd.to_datetime(hyper_parameters['holidays'])})
+
+    return Prophet(
+        growth=hyper_parameters['growth'],
+        holidays=holidays,
+        seasonality_mode=hyper_parameters['seasonality_mode'],
+        seasonality_prior_scale=hyper_parameters['seasonality_prior_scale'],
+        yearly_seasonality=hyper_parameters['yearly_seasonality'],
+        weekly_seasonality=hyper_parameters['weekly_seasonality'],
+        daily_seasonality=hyper_parameters['daily_seasonality'],
+        changepoints=changepoints,
+        n_changepoints=hyper_parameters['n_changepoints'],
+        changepoint_range=hyper_parameters['changepoint_range'],
+        changepoint_prior_scale=hyper_parameters['changepoint_prior_scale'],
+        uncertainty_samples=uncertainty_samples
+    )
+
+
+def changepoints_before(changepoints: list, cutoff: 'pd.Timestamp' = None) -> list:
+    """The specified changepoints before a cutoff, an empty list (not automatic changepoints) when none are left"""
+    import pandas as pd
+
+    return [changepoint for changepoint in pd.to_datetime(changepoints) if cutoff is None or changepoint < cutoff]
+
+
+def generate_validation_cutoffs(df: 'pd.DataFrame', horizon: 'pd.Timedelta', initial_days: int = None,
+                                period_days: int = None) -> ['pd.Timestamp']:
+    """
+    The cutoffs of a cross validation of a history
+
+    Args:
+        initial_days: The minimum number of days of history before the first cutoff, defaults to 3 horizons
+        period_days: The number of days between cutoffs, defaults to half a horizon
+    """
+    import pandas as pd
+    from fbprophet.diagnostics import generate_cutoffs
+
+    return generate_cutoffs(df, horizon,
+                            pd.Timedelta(days=initial_days) if initial_days else 3 * horizon,
+                            pd.Timedelta(days=period_days) if period_days else 0.5 * horizon)
+
+
+def fit_and_predict_cutoff(m: 'Prophet', df: 'pd.DataFrame', cutoff: 'pd.Timestamp',
+                           horizon: 'pd.Timedelta') -> 'pd.DataFrame':
+    """
+    Fits an unfitted model on the log transformed history up to `cutoff` and predicts the following `horizon`
+
+    Returns:
+        A data frame with the columns ds, yhat, yhat_lower and yhat_upper (when the model estimates intervals),
+        y and cutoff at original scale
+    """
+    import numpy as np
+
+    np.warnings.filterwarnings('ignore')
+
+    m.fit(df[df['ds'] <= cutoff])
+
+    predicted_df = df[(df['ds'] > cutoff) & (df['ds'] <= cutoff + horizon)]
+    result = m.predict(predicted_df[['ds']])
+    result = result[[column for column in ['ds', 'yhat', 'yhat_lower', 'yhat_upper'] if column in result]]
+    result['y'] = predicted_df['y'].values
+    result['cutoff'] = cutoff
+
+    # Data at original scale
+    for column in ['y', 'yhat', 'yhat_lower', 'yhat_upper']:
+        if column in result:
+            result[column] = np.exp(result[column])
+    return result
+
+
+def cross_validate_cutoff(hyper_parameters: dict, df: 'pd.DataFrame', cutoff: 'pd.Timestamp',
+                          horizon: 'pd.Timedelta') -> 'pd.DataFrame':
+    """
+    Fits the model of a stored forecast on the log transformed history up to `cutoff` and predicts the following
+    `horizon`, see `fit_and_predict_cutoff`
+    """
+    return fit_and_predict_cutoff(build_model(hyper_parameters, cutoff), df, cutoff, horizon)
+
+
+def _cross_validate_task(task: tuple) -> (int, 'pd.Timestamp', 'pd.DataFrame', Exception):
+    """Runs `cross_validate_cutoff` in a worker process, returning instead of raising the exception of a failed fit"""
+    forecast_id, cutoff, hyper_parameters, df, horizon = task
+    try:
+        return forecast_id, cutoff, cross_validate_cutoff(hyper_parameters, df, cutoff, horizon), None
+    except Exception as e:
+        return forecast_id, cutoff, None, e
 
 
 def run_forecast_cross_validation(forecast_id: int, horizon_days: int, initial_days: int = None,
-                                  period_days: int = None):
-    handler = logging.StreamHandler(sys.stdout)
-    handler.setLevel(logging.DEBUG)
-    logging.getLogger().addHandler(handler)
-
-    with mara_db.postgresql.postgres_cursor_context('mara') as cursor:
-        cursor.execute("SELECT model FROM forecasts WHERE id = %s", (forecast_id,))
-        result = cursor.fetchone()
-
-    if result:
-        model = pickle.loads(result[0])
-
-        logging.info(f'Running cross validation for metric forecast id={forecast_id}')
-        cross_validation_df = cross_validation(
-            model,
-            horizon=f'{str(horizon_days)} days',
-            initial=f'{str(initial_days)} days' if initial_days else None,
-            period=f'{str(period_days)} days' if period_days else None
-        )
-
-        # Data at original scale
-        cross_validation_df['y'] = np.exp(cross_validation_df['y'])
-        cross_validation_df['yhat'] = np.exp(cross_validation_df['yhat'])
-        cross_validation_df['yhat_upper'] = np.exp(cross_validation_df['yhat_upper'])
-        cross_validation_df['yhat_lower'] = np.exp(cross_validation_df['yhat_lower'])
-
-        logging.info(f'Calculating performance metrics from cross-validation results of forecast id={forecast_id}')
-        metrics_df = performance_metrics(cross_validation_df, rolling_window=1)
-
-        cross_validation_df_pickled = pickle.dumps(cross_validation_df)
-        metrics_df_pickled = pickle.dumps(metrics_df)
+                                  period_days: int = None, workers: int = None):
+    """
+    Cross validates the model of a forecast by refitting it on the history up to several cutoffs
+
+    Args:
+        forecast_id: The id of the forecast in the `forecasts` table
+        horizon_days: The number of days to forecast after each cutoff
+        initial_days: The minimum number of days of history before the first cutoff, defaults to 3 horizons
+        period_days: The number of days between cutoffs, defaults to half a horizon
+        workers: When given, cutoffs are fitted in parallel by this number of worker processes
+    """
+    instrumentation.add_stdout_logging_handler(logging.getLogger())
+
+    return run_cross_validations([forecast_id], horizon_days, initial_days, period_days, workers).get(forecast_id)
+
+
+def run_all_cross_validations(horizon_days: int, initial_days: int = None, period_days: int = None,
+                              workers: int = None, timeout: int = None) -> {str: bool}:
+    """
+    Cross validates the latest forecast of every configured metric, sharing one pool of worker processes
+
+    Args:
+        horizon_days: The number of days to forecast after each cutoff
+        initial_days: The minimum number of days of history before the first cutoff, defaults to 3 horizons
+        period_days: The number of days between cutoffs, defaults to half a horizon
+        workers: The number of worker processes fitting cutoffs in parallel, defaults to the number of CPUs
+        timeout: The number of seconds after which no further cutoffs are fitted
+
+    Returns:
+        Whether the cross validation succeeded per metric name
+    """
+    from mara_prophet.forecast import normalized_metric_name
+
+    metric_names = [normalized_metric_name(forecast.metric_name)
+                    for forecast in mara_prophet.config.forecasts()]
+
+    with connections.cursor_context('mara') as cursor:
+        cursor.execute('''
+        SELECT forecast_id, metric_name
+        FROM latest_forecasts WHERE metric_name = ANY(%s)''', (metric_names,))
+        latest_forecasts = dict(cursor.fetchall())
+
+    results = run_cross_validations(list(latest_forecasts.keys()), horizon_days, initial_days, period_days,
+                                    workers or multiprocessing.cpu_count(), timeout)
+    return {metric_name: results[forecast_id] for forecast_id, metric_name in latest_forecasts.items()}
+
 
+def run_cross_validations(forecast_ids: [int], horizon_days: int, initial_days: int = None, period_days: int = None,
+                          workers: int = None, timeout: int = None) -> {int: bool}:
+    """
+    Cross validates the models of multiple forecasts, streaming the results of each cutoff into
+    `forecasts_cross_validation` and the resulting performance metrics into `forecasts_cross_validation_metrics`
+
+    Args:
+        forecast_ids: The ids of the forecasts in the `forecasts` table
+        horizon_days: The number of days to forecast after each cutoff
+        initial_days: The minimum number of days of history before the first cutoff, defaults to 3 horizons
+        period_days: The number of days between cutoffs, defaults to half a horizon
+        workers: When given, the cutoffs of all forecasts are fitted in parallel by this number of worker processes
+        timeout: The number of seconds after which no further cutoffs are fitted. Cutoffs that are being fitted
+                 in worker processes at that time are terminated
+
+    Returns:
+        Whether the cross validation succeeded per forecast id
+    """
+    import numpy as np
+    import pandas as pd
+    from fbprophet.diagnostics import performance_metrics
+
+    from mara_prophet.forecast import ensure_mara_tables
+
+    ensure_mara_tables()
+
+    horizon = pd.Timedelta(days=horizon_days)
+    deadline = time.monotonic() + timeout if timeout else None
+
+    validations = {}  # forecast id -> (metric name, hyper parameters, log transformed source data, cutoffs)
+    succeeded = {}
+    for forecast_id in forecast_ids:
+        with connections.cursor_context('mara') as cursor:
+            cursor.execute("SELECT metric_name, source_df, hyper_parameters FROM forecasts WHERE id = %s",
+                           (forecast_id,))
+            result = cursor.fetchone()
+
+        if not result:
+            logging.info(f'No forecast found with id={forecast_id}')
+            succeeded[forecast_id] = False
+            continue
+        if result[1] is None:
+            logging.info(f'The source data of the forecast with id={forecast_id} has been compacted')
+            succeeded[forecast_id] = False
+            continue
+
+        df = serialization.decode_dataframe(result[1])
+        df['ds'] = pd.to_datetime(df['ds'])
+        df['y'] = np.log(df['y'])
+        df = df.sort_values('ds').reset_index(drop=True)
+
+        try:
+            cutoffs = generate_validation_cutoffs(df, horizon, initial_days, period_days)
+        except ValueError as e:
+            logging.error(f'Can not cross validate forecast id={forecast_id}: {e}')
+            succeeded[forecast_id] = False
+            continue
+
+        logging.info(f'Running cross validation for metric forecast id={forecast_id} with {len(cutoffs)} cutoffs')
+        validations[forecast_id] = (result[0], result[2], df, cutoffs)
+
+    cross_validation_dfs = {forecast_id: [] for forecast_id in validations}
+
+    def cutoff_finished(forecast_id: int, cutoff: 'pd.Timestamp', cross_validation_df: 'pd.DataFrame'):
         insert_cross_validation_results_into_table(forecast_id, horizon_days, initial_days, period_days,
-                                                   cross_validation_df_pickled, metrics_df_pickled)
+                                                   serialization.encode_dataframe(cross_validation_df), None,
+                                                   cutoff.to_pydatetime())
+        logging.info(f'Finished cutoff {cutoff:%Y-%m-%d} of forecast id={forecast_id}')
 
+        cross_validation_dfs[forecast_id].append(cross_validation_df)
+        if len(cross_validation_dfs[forecast_id]) == len(validations[forecast_id][3]):
+            logging.info(f'Calculating performance metrics from cross-validation results of forecast id={forecast_id}')
+            metrics_df = performance_metrics(pd.concat(cross_validation_dfs.pop(forecast_id), ignore_index=True),
+                                             rolling_window=1)
+            insert_performance_metrics_into_table(forecast_id, validations[forecast_id][0], horizon_days,
+                                                  initial_days, period_days, metrics_df)
+            succeeded[forecast_id] = True
+
+    def cutoff_failed(forecast_id: int, cutoff: 'pd.Timestamp', exception: Exception):
+        logging.error(f'Cross validation of forecast id={forecast_id} failed at cutoff {cutoff:%Y-%m-%d}: '
+                      f'{exception!r}')
+        cross_validation_dfs.pop(forecast_id, None)
+        succeeded[forecast_id] = False
+
+    tasks = [(forecast_id, cutoff) for forecast_id, (_, _, _, cutoffs) in validations.items() for cutoff in cutoffs]
+
+    if workers:
+        # leaving the pool terminates its worker processes, also those still fitting cutoffs after a timeout
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.imap_unordered(_cross_validate_task,
+                                          [(forecast_id, cutoff, validations[forecast_id][1],
+                                            validations[forecast_id][2], horizon) for forecast_id, cutoff in tasks])
+            try:
+                for _ in tasks:
+                    forecast_id, cutoff, cross_validation_df, exception = results.next(
+                        timeout=max(deadline - time.monotonic(), 0) if deadline else None)
+                    if forecast_id not in cross_validation_dfs:
+                        continue
+                    try:
+                        if exception:
+                            raise exception
+                        cutoff_finished(forecast_id, cutoff, cross_validation_df)
+                    except Exception as e:
+                        cutoff_failed(forecast_id, cutoff, e)
+            except multiprocessing.TimeoutError:
+                logging.error(f'Cross validations timed out after {timeout} seconds, terminating remaining cutoffs')
     else:
-        logging.info(f'No forecast found with id={forecast_id}')
+        for forecast_id, cutoff in tasks:
+            if deadline and time.monotonic() > deadline:
+                logging.error(f'Cross validations timed out after {timeout} seconds, skipping remaining cutoffs')
+                break
+            if forecast_id not in cross_validation_dfs:
+                continue
+            try:
+                cutoff_finished(forecast_id, cutoff, cross_validate_cutoff(validations[forecast_id][1],
+                                                                           validations[forecast_id][2],
+                                                                           cutoff, horizon))
+            except Exception as e:
+                cutoff_failed(forecast_id, cutoff, e)
+
+    return {forecast_id: succeeded.get(forecast_id, False) for forecast_id in forecast_ids}
@@ -1,18 +1,11 @@
+import functools
+
 import flask
 from mara_page import acl, navigation, response, _, html, bootstrap
-from mara_prophet import config
+from mara_prophet import config, connections, plot_data, serialization
+from mara_prophet.forecast import normalized_metric_name
 import io
-import pickle
-import mara_db.postgresql
 import base64
-import pandas as pd
-
-import matplotlib
-
-matplotlib.use('agg')
-
-from matplotlib import pyplot as plt
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
 
 acl_resource = acl.AclResource(name='Forecasts')
 
@@ -30,71 +23,44 @@ def forecasts_navigation_entry():
 @blueprint.route('/')
 @acl.require_permission(acl_resource)
 def view_plots():
+    # filter by metric name and paginate, so that only the plots of one page of metrics are requested
+    search = flask.request.args.get('q', '').strip()
+    page = max(flask.request.args.get('page', 1, type=int), 1)
+    per_page = config.forecasts_per_page()
+
+    forecasts = [forecast for forecast in config.forecasts()
+                 if search.lower() in forecast.metric_name.lower()]
+    number_of_pages = max((len(forecasts) + per_page - 1) // per_page, 1)
+    page = min(page, number_of_pages)
+    forecasts = forecasts[(page - 1) * per_page:page * per_page]
+
     return response.Response(
         html=[
             _.div(id='forecast-container')[
                 _.div(class_="")[
-                    [[_.div(class_='row')[
-                          _.div(class_='col-xl-12')[_.div(class_='section-header')[forecast.metric_name]]],
-                      _.div(class_='row')[
-                          _.div(class_='col-xl-12')[
-                              _.p()['Number of days: ' + str(forecast.number_of_days), _.br(),
-                                    'Time-series query: ',
-                                    html.highlight_syntax(forecast.time_series_query,
-                                                          language='postgresql')],
-
-                              bootstrap.card(
-                                  header_left='Forecast plot of "' + forecast.metric_name + '"',
-                                  header_right=_.div()[
-                                      # config.forecast_table_name
-                                      # _.a(class_='query-control', style='margin-right: 10px',
-                                      #     href='#')[
-                                      #     _.span(class_='fa fa-download')[' ']],
-
-                                      _.a(class_='query-control',
-                                          href=f"javascript:showQueryDetails('"
-                                          f"{flask.url_for('forecasts.query_details', name=forecast.metric_name)}')")[
-                                          _.span(class_='fa fa-eye')[' ']]
-                                  ],
-                                  body=[
-                                      html.asynchronous_content(
-                                          flask.url_for(
-                                              'forecasts.get_plot_image',
-                                              name=forecast.metric_name.lower().replace(' ', '_').replace('-', '_'),
-                                              components='False')),
-                                      _.br(), _.br(),
-                                      _.div(class_='modal fade', id='query-details-dialog',
-                                            tabindex="-1")[
-                                          _.div(class_='modal-dialog modal-lg', role='document')[
-                                              _.div(class_='modal-content')[
-                                                  _.div(class_='modal-header')[
-                                                      _.h5(class_='modal-title')['Time-series query'],
-                                                      _.button(
-                                                          **{'type': "button", 'class': "close",
-                                                             'data-dismiss': "modal",
-                                                             'aria-label': "Close"})[
-                                                          _.span(**{'aria-hidden': 'true'})['&times']]],
-                                                  _.div(class_='modal-body', id='query-details')['']
-                                              ]
-                                          ]],
-                                  ])
-                          ]
-                          ,
-                          _.div(class_='col-xl-12')[
-                              bootstrap.card(
-                                  header_left='Forecast components (trend, holidays, seasonality) of "{}"'.format(
-                                      forecast.metric_name),
-                                  header_right='',
-                                  body=[
-                                      html.asynchronous_content(
-                                          flask.url_for(
-                                              'forecasts.get_plot_image',
-                                              name=forecast.metric_name.lower().replace(' ', '_').replace('-', '_'),
-                                              components='True')),
-                                  ])], _.hr()
-                      ]]
-                     for forecast in config.forecasts()
-                     ]
+                    _.div(class_='row')[
+                        _.div(class_='col-xl-12')[
+                            _.form(method='get', action=flask.url_for('forecasts.view_plots'))[
+                                _.input(type='text', name='q', value=search, class_='form-control',
+                                        placeholder='Filter by metric name')],
+                            _.br(),
+                            summary_table(forecasts),
+                            pagination(search, page, number_of_pages)]],
+                    [forecast_section(forecast) for forecast in forecasts],
+                    pagination(search, page, number_of_pages) if forecasts else '',
+                    _.div(class_='modal fade', id='query-details-dialog', tabindex="-1")[
+                        _.div(class_='modal-dialog modal-lg', role='document')[
+                            _.div(class_='modal-content')[
+                                _.div(class_='modal-header')[
+                                    _.h5(class_='modal-title')['Time-series query'],
+                                    _.button(
+                                        **{'type': "button", 'class': "close",
+                                           'data-dismiss': "modal",
+                                           'aria-label': "Close"})[
+                                        _.span(**{'aria-hidden': 'true'})['&times']]],
+                                _.div(class_='modal-body', id='query-details')['']
+                            ]
+                        ]]
                 ]
             ],
             _.script['''''']
@@ -104,27 +70,173 @@ def view_plots():
             'https://fonts.googleapis.com/css?family=Open+Sans:300,400,700',
             flask.url_for('forecasts.static', filename='forecast.css')],
         js_files=[
-            flask.url_for('forecasts.static', filename='forecast.js'),
-            'https://www.gstatic.com/charts/loader.js'
+            'https://www.gstatic.com/charts/loader.js',
+            flask.url_for('forecasts.static', filename='forecast.js')
         ]
     )
 
 
-def get_main_plot_figure(name, source_df, forecast_df):
-    source_df.set_index('ds', inplace=True)
-    forecast_df.set_index('ds', inplace=True)
-    source_df.index = pd.to_datetime(source_df.index)
+def forecast_section(forecast):
+    """The description and the (lazily loaded) plots of a single forecast"""
+    name = normalized_metric_name(forecast.metric_name)
+    return [_.div(class_='row', id=f'forecast-{name}')[
+                _.div(class_='col-xl-12')[_.div(class_='section-header')[forecast.metric_name]]],
+            _.div(class_='row')[
+                _.div(class_='col-xl-12')[
+                    _.p()['Horizon: ' + forecast.horizon_label(), _.br(),
+                          'Time-series query: ',
+                          html.highlight_syntax(forecast.time_series_query,
+                                                language='postgresql')],
+
+                    bootstrap.card(
+                        header_left='Forecast plot of "' + forecast.metric_name + '"',
+                        header_right=_.div()[
+                            _.span(class_='forecast-job-status', id=f'forecast-job-status-{name}')[''],
+                            _.a(class_='query-control', style='margin-right: 10px', title='Refresh forecast',
+                                href=f"javascript:refreshForecast('"
+                                f"{flask.url_for('forecasts.enqueue_forecast_job', name=forecast.metric_name)}', "
+                                f"'forecast-job-status-{name}')")[
+                                _.span(class_='fa fa-refresh')[' ']],
+                            _.a(class_='query-control',
+                                href=f"javascript:showQueryDetails('"
+                                f"{flask.url_for('forecasts.query_details', name=forecast.metric_name)}')")[
+                                _.span(class_='fa fa-eye')[' ']]
+                        ],
+                        body=[
+                            _.div(class_='forecast-chart',
+                                  **{'data-url': flask.url_for('forecasts.get_plot_data', name=name,
+                                                               points=config.main_plot_max_points()),
+                                     'data-label': forecast.metric_name})['']
+                            if config.client_side_rendering() else
+                            lazy_content(f'forecast-plot-{name}',
+                                         flask.url_for('forecasts.get_plot_image', name=name, components='False')),
+                            _.br(), _.br()
+                        ])
+                ]
+                ,
+                _.div(class_='col-xl-12')[
+                    bootstrap.card(
+                        header_left='Forecast components (trend, holidays, seasonality) of "{}"'.format(
+                            forecast.metric_name),
+                        header_right='',
+                        body=[
+                            lazy_content(f'forecast-components-{name}',
+                                         flask.url_for('forecasts.get_plot_image', name=name, components='True')),
+                        ])],
+                _.div(class_='col-xl-12')[
+                    bootstrap.card(
+                        header_left='Anomalies of "{}" since the last forecast'.format(forecast.metric_name),
+                        header_right='',
+                        body=lazy_content(f'forecast-anomalies-{name}',
+                                          flask.url_for('forecasts.get_anomalies', name=name)))], _.hr()
+            ]]
+
+
+def lazy_content(div_id: str, url: str):
+    """Like `html.asynchronous_content`, but the content is only loaded once the div is scrolled into view"""
+    return _.div(id=div_id, class_='lazy-content', **{'data-url': url})['']
+
+
+def summary_table(forecasts: list):
+    """The latest run, cross validation accuracy and anomalies of forecasts, from indexed columns only"""
+    names = {forecast.metric_name: normalized_metric_name(forecast.metric_name) for forecast in forecasts}
+    summaries = forecast_summaries(list(names.values()))
+
+    def number(value, format_spec: str) -> str:
+        return format(value, format_spec) if value is not None else ''
+
+    return _.div(class_='metrics-table')[
+        _.table(class_='table table-sm')[
+            _.thead[_.tr[_.th['Metric'], _.th['Last forecast'], _.th['Horizon'],
+                         _.th['MAPE'], _.th['Coverage'], _.th['Anomalies']]],
+            _.tbody[[
+                _.tr[_.td[_.a(href='#forecast-' + names[forecast.metric_name])[forecast.metric_name]],
+                     _.td[number(summaries.get(names[forecast.metric_name], {}).get('forecast_ts'),
+                                 '%Y-%m-%d %H:%M') or 'never'],
+                     _.td[forecast.horizon_label()],
+                     _.td[number(summaries.get(names[forecast.metric_name], {}).get('mape'), '.1%')],
+                     _.td[number(summaries.get(names[forecast.metric_name], {}).get('coverage'), '.1%')],
+                     _.td[number(summaries.get(names[forecast.metric_name], {}).get('anomalies') or None, 'd')]]
+                for forecast in forecasts]]]]
+
+
+def forecast_summaries(names: [str]) -> {str: dict}:
+    """
+    The time of the latest forecast run, the mean accuracy of the latest cross validation and the number of
+    anomalies since the latest run per metric
+
+    Args:
+        names: Normalized metric names
+    """
+    if not names:
+        return {}
+    with connections.cursor_context('mara') as cursor:
+        cursor.execute(f'''
+SELECT latest_forecast.metric_name, latest_forecast.forecast_ts, accuracy.mape, accuracy.coverage,
+       anomalies.count
+FROM latest_forecasts latest_forecast
+LEFT JOIN (SELECT DISTINCT ON (metric_name) metric_name, cross_validation_id
+           FROM forecasts_cross_validation_metrics
+           WHERE metric_name = ANY({'%s'})
+           ORDER BY metric_name, cross_validation_id DESC) latest_cross_validation USING (metric_name)
+LEFT JOIN LATERAL (SELECT avg(mape) AS mape, avg(coverage) AS coverage
+                   FROM forecasts_cross_validation_metrics
+                   WHERE cross_validation_id = latest_cross_validation.cross_validation_id) accuracy ON TRUE
+LEFT JOIN LATERAL (SELECT count(*) AS count
+                   FROM forecast_anomalies
+                   WHERE metric_name = latest_forecast.metric_name
+                     AND forecast_id = latest_forecast.forecast_id) anomalies ON TRUE
+WHERE latest_forecast.metric_name = ANY({'%s'})''',
+                       (names, names))
+        return {metric_name: {'forecast_ts': forecast_ts, 'mape': mape, 'coverage': coverage, 'anomalies': anomalies}
+                for metric_name, forecast_ts, mape, coverage, anomalies in cursor.fetchall()}
+
+
+def pagination(search: str, page: int, number_of_pages: int):
+    """Links to the other pages of the (filtered) forecasts"""
+    if number_of_pages <= 1:
+        return ''
+    return _.nav[_.ul(class_='pagination')[
+        [_.li(class_='page-item' + (' active' if number == page else ''))[
+             _.a(class_='page-link',
+                 href=flask.url_for('forecasts.view_plots', page=number, **({'q': search} if search else {})))[
+                 str(number)]]
+         for number in range(1, number_of_pages + 1)]]]
+
+
+def pyplot():
+    """Imports matplotlib's pyplot with the non-interactive 'agg' backend, only on first use"""
+    import matplotlib
+    matplotlib.use('agg')
+    from matplotlib import pyplot as plt
+    return plt
+
+
+def figure_to_png(figure) -> str:
+    """Rasterizes a figure into a base64 encoded PNG and releases it"""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+
+    output = io.BytesIO()
+    FigureCanvas(figure).print_png(output)
+    pyplot().close(figure)
+    return str(base64.b64encode(output.getvalue()).decode("utf-8"))
 
-    # this data frame has the predicted data starting from the last date of the source time series
-    predicted_data_df = forecast_df.loc[(forecast_df.index > max(source_df.index))]
 
-    plot_df = source_df.join(predicted_data_df[['yhat', 'yhat_lower', 'yhat_upper']], how='outer')
+def get_main_plot_figure(name, plot_series, max_points: int = None):
+    """
+    Plots the actual and the predicted values of a plot series (see `mara_prophet.plot_data.build_plot_series`),
+    downsampled to at most `max_points` (defaults to `config.main_plot_max_points()`)
+    """
+    plot_series = plot_data.downsample_plot_series(
+        plot_series, max_points if max_points is not None else config.main_plot_max_points())
+    ds = plot_series['ds'].values
 
-    fig = plt.figure(facecolor='w', figsize=(17, 4))
+    fig = pyplot().figure(facecolor='w', figsize=(17, 4))
     ax = fig.add_subplot(111)
-    ax.plot(plot_df.y)
-    ax.plot(plot_df.yhat, color='black', linestyle=':')
-    ax.fill_between(plot_df.index, plot_df['yhat_upper'], plot_df['yhat_lower'], alpha=0.6, color='darkgray')
+    ax.plot(ds, plot_series['y'].values)
+    ax.plot(ds, plot_series['yhat'].values, color='black', linestyle=':')
+    ax.fill_between(ds, plot_series['yhat_upper'].values, plot_series['yhat_lower'].values,
+                    alpha=0.6, color='darkgray')
     ax.set_xlabel('Date')
     ax.set_ylabel(str(name).replace('_', ' ').capitalize())
 
@@ -136,8 +248,13 @@ def get_main_plot_figure(name, source_df, forecast_df):
     return fig
 
 
+def get_main_plot_png(name, plot_series) -> str:
+    """Renders the main forecast plot as a base64 encoded PNG"""
+    return figure_to_png(get_main_plot_figure(name, plot_series))
+
+
 def get_components_figure(m, fcst):
-    uncertainty = True
+    uncertainty = bool(m.uncertainty_samples)
     plot_cap = True
     weekly_start = 0
     yearly_start = 0
@@ -148,7 +265,7 @@ def get_components_figure(m, fcst):
     components.extend([name for name in m.seasonalities if name in fcst])
     npanel = len(components)
 
-    fig, axes = plt.subplots(npanel, 1, facecolor='w', figsize=(17, 3 * npanel))
+    fig, axes = pyplot().subplots(npanel, 1, facecolor='w', figsize=(17, 3 * npanel))
 
     if npanel == 1:
         axes = [axes]
@@ -178,9 +295,7 @@ def get_components_figure(m, fcst):
 
     fig.tight_layout()
 
-    output = io.BytesIO()
-    FigureCanvas(fig).print_png(output)
-    png_bytes = str(base64.b64encode(output.getvalue()).decode("utf-8"))
+    png_bytes = figure_to_png(fig)
 
     return png_bytes
 
@@ -189,33 +304,168 @@ def get_components_figure(m, fcst):
 @acl.require_permission(acl_resource)
 def get_plot_image(name, components):
     # plot the latest forecast
-    with mara_db.postgresql.postgres_cursor_context('mara') as cursor:
+    forecast_ts, modified_ts = latest_forecast(name)
+    if not forecast_ts:
+        return 'No data yet.'
+
+    etag = f'{name}-{modified_ts.timestamp()}-{components}'
+    if etag_matches(etag):
+        return conditional_response(flask.make_response(''), etag, modified_ts)
+
+    response = flask.make_response(
+        str(_.img(src="data:image/png;base64," + get_plot_png(name, forecast_ts, modified_ts, components == 'True'))))
+    return conditional_response(response, etag, modified_ts)
+
+
+@blueprint.route('/_data/<string:name>')
+@acl.require_permission(acl_resource)
+def get_plot_data(name):
+    """
+    The actual and predicted values of the latest forecast as JSON columns, for client-side charting
+
+    Query parameters:
+        start, end: Optional ISO dates (without time zone) for restricting the range
+        points: Optional maximum number of points (at least 3), longer series are downsampled
+    """
+    import numpy as np
+    import pandas as pd
+
+    start, end = flask.request.args.get('start'), flask.request.args.get('end')
+    try:
+        start_ts, end_ts = [pd.Timestamp(value) if value else None for value in [start, end]]
+    except ValueError as e:
+        return flask.jsonify({'metric_name': name, 'error': f'Invalid date: {e}'}), 400
+    if any(ts is not None and ts.tzinfo is not None for ts in [start_ts, end_ts]):
+        return flask.jsonify({'metric_name': name, 'error': 'Dates with time zones are not supported'}), 400
+
+    points = flask.request.args.get('points', type=int)
+    if 'points' in flask.request.args and (points is None or points < 3):
+        return flask.jsonify({'metric_name': name, 'error': 'points must be an integer of at least 3'}), 400
+
+    forecast_ts, modified_ts = latest_forecast(name)
+    if not forecast_ts:
+        return flask.jsonify({'metric_name': name, 'error': 'No data yet.'}), 404
+
+    etag = f'{name}-{modified_ts.timestamp()}-{start}-{end}-{points}'
+    if etag_matches(etag):
+        return conditional_response(flask.make_response(''), etag, modified_ts)
+
+    plot_series = plot_data.get_plot_series(name, forecast_ts, modified_ts)
+    if start_ts is not None:
+        plot_series = plot_series[plot_series['ds'] >= start_ts]
+    if end_ts is not None:
+        plot_series = plot_series[plot_series['ds'] <= end_ts]
+    if points:
+        plot_series = plot_data.downsample_plot_series(plot_series, points)
+
+    def values(column: str) -> list:
+        array = plot_series[column].values.round(6)
+        return np.where(np.isnan(array), None, array).tolist()
+
+    response = flask.jsonify({
+        'metric_name': name,
+        'forecast_ts': forecast_ts.isoformat(),
+        # milliseconds since epoch, as expected by javascript dates
+        'ds': (plot_series['ds'].values.astype('datetime64[ms]').astype(np.int64)).tolist(),
+        **{column: values(column) for column in ['y', 'yhat', 'yhat_lower', 'yhat_upper']}})
+    return conditional_response(response, etag, modified_ts)
+
+
+def latest_forecast(name: str) -> tuple:
+    """
+    The timestamp of the latest forecast run of a metric and of its last modification (e.g. by adding deferred
+    intervals), (None, None) when it has never been run
+    """
+    with connections.cursor_context('mara') as cursor:
         cursor.execute(f'''
-        SELECT metric_name, forecasts_df, source_df, components_figure 
-        FROM forecasts WHERE metric_name = {'%s'}
-        ORDER BY forecast_ts DESC
-        LIMIT 1''', (name,))
-        result = cursor.fetchone()
+        SELECT forecast_ts, coalesce(modified_ts, forecast_ts)
+        FROM latest_forecasts WHERE metric_name = {'%s'}''', (name,))
+        return cursor.fetchone() or (None, None)
 
-    png_bytes = None
-    if result:
-        forecast_df = pickle.loads(result[1])
-        source_df = pickle.loads(result[2])
-        components_figure = pickle.loads(result[3])
 
-        png_bytes = components_figure
-        if components != 'True':
-            # get main forecast plot figure
-            figure = get_main_plot_figure(name, source_df, forecast_df)
+def etag_matches(etag: str) -> bool:
+    """Whether the browser already has this version, so that it can be confirmed without fetching any data"""
+    return flask.request.if_none_match.contains(etag)
 
-            output = io.BytesIO()
-            FigureCanvas(figure).print_png(output)
-            png_bytes = str(base64.b64encode(output.getvalue()).decode("utf-8"))
 
-    return str(_.img(src="data:image/png;base64," +
-                         png_bytes
-                     )
-               ) if result else 'No data yet.'
+def conditional_response(response: flask.Response, etag: str, modified_ts) -> flask.Response:
+    """Lets browsers revalidate and skip the transfer until a newer forecast has been run"""
+    response.set_etag(etag)
+    response.last_modified = modified_ts
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(flask.request)
+
+
+@functools.lru_cache(maxsize=256)
+def get_plot_png(name: str, forecast_ts, modified_ts, components: bool) -> str:
+    """
+    Returns the base64 encoded main or components plot of a forecast run,
+    cached per (metric_name, forecast_ts, modified_ts)
+    """
+    with connections.cursor_context('mara') as cursor:
+        cursor.execute(f'''
+        SELECT components_figure, main_figure
+        FROM forecasts WHERE metric_name = {'%s'} AND forecast_ts = {'%s'}''', (name, forecast_ts))
+        components_figure, main_figure = cursor.fetchone()
+
+    if components:
+        return serialization.decode_figure(components_figure)
+    if main_figure is not None:
+        return serialization.decode_figure(main_figure)
+
+    # forecasts that have been run before main figures were pre-rendered
+    return get_main_plot_png(name, plot_data.get_plot_series(name, forecast_ts, modified_ts))
+
+
+@blueprint.route('/_anomalies/<string:name>')
+@acl.require_permission(acl_resource)
+def get_anomalies(name):
+    """The actuals outside the uncertainty interval of the latest forecast run, as found by `detect_anomalies`"""
+    with connections.cursor_context('mara') as cursor:
+        cursor.execute(f'''
+        SELECT ds, y, yhat, yhat_lower, yhat_upper, deviation
+        FROM forecast_anomalies
+        JOIN latest_forecasts USING (metric_name, forecast_id)
+        WHERE metric_name = {'%s'}
+        ORDER BY ds DESC
+        LIMIT 100''', (name,))
+        rows = cursor.fetchall()
+
+    if not rows:
+        return str(_.p()['No anomalies'])
+    return str(bootstrap.table(
+        headers=['Date', 'Actual', 'Forecast', 'Lower bound', 'Upper bound', 'Deviation'],
+        rows=[_.tr[_.td[f'{ds:%Y-%m-%d %H:%M}' if ds.hour or ds.minute else f'{ds:%Y-%m-%d}'],
+                   [_.td[f'{value:,.2f}'] for value in [y, yhat, yhat_lower, yhat_upper]],
+                   _.td[f'{deviation:+.2f}']]
+              for ds, y, yhat, yhat_lower, yhat_upper, deviation in rows]))
+
+
+@blueprint.route('/_jobs/<string:name>', methods=['POST'])
+@acl.require_permission(acl_resource)
+def enqueue_forecast_job(name):
+    """Requests a refresh of a forecast, returns the id of the queued (or already pending) job"""
+    from mara_prophet import jobs
+
+    if not any(forecast.metric_name == name for forecast in config.forecasts()):
+        return flask.jsonify({'error': f'There is no defined forecast with name "{name}"'}), 404
+    job_id = jobs.enqueue_forecasts([name])[name]
+    return flask.jsonify({'job_id': job_id, 'status_url': flask.url_for('forecasts.forecast_job_status',
+                                                                        job_id=job_id)}), 202
+
+
+@blueprint.route('/_jobs/<int:job_id>')
+@acl.require_permission(acl_resource)
+def forecast_job_status(job_id):
+    """The state of a forecast job, for polling its progress"""
+    from mara_prophet import jobs
+
+    status = jobs.job_status(job_id)
+    if not status:
+        return flask.jsonify({'error': f'There is no job with id {job_id}'}), 404
+    return flask.jsonify({key: value.isoformat() if hasattr(value, 'isoformat') else value
+                          for key, value in status.items()})
 
 
 @blueprint.route('/_query_details/<string:name>')
@@ -225,9 +475,9 @@ def query_details(name):
     for forecast in config.forecasts():
         if forecast.metric_name == name:
             query = forecast.time_series_query
-            days = forecast.number_of_days
+            horizon = forecast.horizon_label()
             break
     return str(bootstrap.table(
         headers=[],
         rows=[_.tr[_.td[html.highlight_syntax(query, language='postgresql')]],
-              _.tr[_.td['Number of days forecasted: ' + str(days)]]]))
+              _.tr[_.td['Forecasted: ' + horizon]]]))
@@ -8,6 +8,7 @@ setup(
     install_requires=[
         'mara-db>=3.2.0',
         'fbprophet==0.6',
+        'pyarrow>=0.17.0',
     ],
 
     packages=find_packages(),